@@ -0,0 +1,105 @@
+import argparse
+import os
+import re
+import sys
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+from transformers import AutoModelForCausalLM
+
+INFERENCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "inference")
+sys.path.append(INFERENCE_DIR)
+from mmtokenizer import _MMSentencePieceTokenizer
+from codecmanipulator import CodecManipulator
+from kvcache import PreallocatedCache, QuantizedKVCache
+
+
+def cache_bytes(cache):
+    """Memory held by the buffers of a PreallocatedCache."""
+    return sum(buffer.nbytes for buffer in cache._key_buffers + cache._value_buffers if buffer is not None)
+
+
+def build_prompt(mmtokenizer, codectool, genre_txt, lyrics_txt):
+    """Stage 1 prompt of the first lyric segment, as built by infer.py without an audio prompt."""
+    with open(genre_txt) as f:
+        genres = f.read().strip()
+    with open(lyrics_txt) as f:
+        segments = re.findall(r"\[(\w+)\](.*?)(?=\[|\Z)", f.read(), re.DOTALL)
+    lyrics = [f"[{segment[0]}]\n{segment[1].strip()}\n\n" for segment in segments]
+    instruction = f"Generate music from the given lyrics segment by segment.\n[Genre] {genres}\n" + "\n".join(lyrics)
+    return (
+        mmtokenizer.tokenize(instruction)
+        + mmtokenizer.tokenize("[start_of_segment]")
+        + mmtokenizer.tokenize(lyrics[0])
+        + [mmtokenizer.soa]
+        + codectool.sep_ids
+    )
+
+
+@torch.no_grad()
+def compare(model, prompt_ids, reference_ids):
+    """Teacher-forces `reference_ids` after `prompt_ids` with a bf16 and an int8 cache and compares the next token
+    distributions of every step."""
+    caches = {"bf16": PreallocatedCache(), "int8": QuantizedKVCache()}
+    logits = {}
+    for name, cache in caches.items():
+        logits[name] = model(input_ids=prompt_ids, past_key_values=cache, use_cache=True, num_logits_to_keep=1).logits[:, -1]
+    kl, top1 = [], []
+    for step in tqdm(range(reference_ids.shape[-1]), desc="Teacher forcing"):
+        log_probs = {name: F.log_softmax(step_logits.float(), dim=-1) for name, step_logits in logits.items()}
+        kl.append(F.kl_div(log_probs["int8"], log_probs["bf16"], log_target=True, reduction="sum").item())
+        top1.append((log_probs["int8"].argmax(-1) == log_probs["bf16"].argmax(-1)).item())
+        token = reference_ids[:, step : step + 1]
+        for name, cache in caches.items():
+            logits[name] = model(input_ids=token, past_key_values=cache, use_cache=True).logits[:, -1]
+    return torch.tensor(kl), torch.tensor(top1, dtype=torch.float), {name: cache_bytes(cache) for name, cache in caches.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quality regression check of the int8 Stage 1 KV cache (--kv_cache_dtype int8) against bf16.")
+    parser.add_argument("--stage1_model", type=str, default="m-a-p/YuE-s1-7B-anneal-en-cot")
+    parser.add_argument("--tokenizer", type=str, default=os.path.join(INFERENCE_DIR, "mm_tokenizer_v0.2_hf", "tokenizer.model"))
+    parser.add_argument("--genre_txt", type=str, default=os.path.join(INFERENCE_DIR, "..", "prompt_egs", "genre.txt"))
+    parser.add_argument("--lyrics_txt", type=str, default=os.path.join(INFERENCE_DIR, "..", "prompt_egs", "lyrics.txt"))
+    parser.add_argument("--num_tokens", type=int, default=1500, help="Length of the bf16 reference continuation that both caches are teacher-forced on.")
+    parser.add_argument("--max_mean_kl", type=float, default=0.01, help="The check fails if the mean KL(bf16 || int8) per step exceeds this value.")
+    parser.add_argument("--min_top1", type=float, default=0.95, help="The check fails if the top-1 agreement of the two caches is lower than this value.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--cuda_idx", type=int, default=0)
+    args = parser.parse_args()
+
+    device = torch.device(f"cuda:{args.cuda_idx}" if torch.cuda.is_available() else "cpu")
+    torch.manual_seed(args.seed)
+    mmtokenizer = _MMSentencePieceTokenizer(args.tokenizer)
+    codectool = CodecManipulator("xcodec", 0, 1)
+    model = AutoModelForCausalLM.from_pretrained(args.stage1_model, torch_dtype=torch.bfloat16, attn_implementation="sdpa").to(device).eval()
+
+    prompt_ids = torch.as_tensor(build_prompt(mmtokenizer, codectool, args.genre_txt, args.lyrics_txt)).unsqueeze(0).to(device)
+    print("Sampling the bf16 reference...")
+    output = model.generate(
+        input_ids=prompt_ids,
+        past_key_values=PreallocatedCache(),
+        max_new_tokens=args.num_tokens,
+        min_new_tokens=args.num_tokens,
+        do_sample=True,
+        top_p=0.93,
+        temperature=1.0,
+        repetition_penalty=1.1,
+        eos_token_id=mmtokenizer.eoa,
+        pad_token_id=mmtokenizer.eoa,
+    )
+    reference_ids = output[:, prompt_ids.shape[-1]:]
+
+    kl, top1, memory = compare(model, prompt_ids, reference_ids)
+    print(f"Steps: {kl.numel()}")
+    print(f"KL(bf16 || int8) per step: mean {kl.mean().item():.5f}, p99 {kl.quantile(0.99).item():.5f}, max {kl.max().item():.5f}")
+    print(f"Top-1 agreement: {top1.mean().item():.4f}")
+    print(f"KV cache memory: bf16 {memory['bf16'] / 2**20:.1f} MiB, int8 {memory['int8'] / 2**20:.1f} MiB")
+
+    passed = kl.mean().item() <= args.max_mean_kl and top1.mean().item() >= args.min_top1
+    print("PASSED" if passed else "FAILED")
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
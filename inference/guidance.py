@@ -0,0 +1,74 @@
+import torch.nn.functional as F
+
+
+class GuidanceSchedule:
+    """Decides on which decoding steps of a `generate` call the unconditional (CFG) stream is run.
+
+    - "always": every step (the default behaviour).
+    - "first_n": the first `num_steps` steps of every call (i.e. of every lyric segment), then no guidance.
+    - "every_k": every `num_steps`-th step; the steps in between are guided with the unconditional scores of the last
+      pass.
+    - "kl": every step until KL(conditional || unconditional) of all unfinished rows has stayed below `kl_threshold`
+      for `num_steps` consecutive steps, then no guidance for the rest of the call. The count stays on the device and
+      is only read every `check_every` steps (one host sync), so the guidance may stop up to `check_every - 1` steps
+      later.
+
+    The tokens of skipped steps are fed to the unconditional stream together with the token of its next pass, tokens
+    that are still pending when the call ends are left out of the unconditional cache. `generate` calls `start` once
+    per call and `step` / `update` on every decoding step, the counters cover all calls.
+    """
+    def __init__(self, mode="always", num_steps=1, kl_threshold=0.0, check_every=8):
+        if mode not in ("always", "first_n", "every_k", "kl"):
+            raise ValueError(f"Unknown guidance schedule {mode!r}.")
+        if mode != "always" and num_steps < 1:
+            raise ValueError(f"The {mode!r} guidance schedule needs num_steps >= 1, got {num_steps}.")
+        self.mode = mode
+        self.num_steps = num_steps
+        self.kl_threshold = kl_threshold
+        self.check_every = max(check_every, 1)
+        self.total_steps = 0
+        self.skipped_steps = 0
+        self.start()
+
+    def start(self):
+        """Starts a new `generate` call."""
+        self.call_step = 0
+        self.low_kl_steps = 0
+        self.stopped = False
+        # log-softmaxed unconditional scores of the last pass, reused by "every_k"
+        self.unconditional_scores = None
+
+    def step(self):
+        """Whether the unconditional stream runs on the current step, the step is counted."""
+        if self.mode == "first_n":
+            run = self.call_step < self.num_steps
+        elif self.mode == "every_k":
+            run = self.call_step % self.num_steps == 0
+        elif self.mode == "kl":
+            if self.call_step % self.check_every == 0 and not self.stopped:
+                self.stopped = bool(self.low_kl_steps >= self.num_steps)
+            run = not self.stopped
+        else:
+            run = True
+        self.call_step += 1
+        self.total_steps += 1
+        self.skipped_steps += not run
+        return run
+
+    def guide(self, conditional_scores, unconditional_scores, unfinished):
+        """The unconditional scores of the current step: `unconditional_scores` (log-softmaxed) if the stream ran,
+        the scores cached by "every_k", or None if the step is unguided. `unfinished` is the (batch,) row mask."""
+        if unconditional_scores is None:
+            return self.unconditional_scores if self.mode == "every_k" else None
+        if self.mode == "every_k":
+            self.unconditional_scores = unconditional_scores
+        elif self.mode == "kl":
+            kl = F.kl_div(unconditional_scores, conditional_scores, log_target=True, reduction="none").sum(dim=-1)
+            kl = kl.masked_fill(~unfinished.bool(), 0)
+            # counted on the device, `step` reads it every `check_every` steps
+            self.low_kl_steps = (self.low_kl_steps + 1) * (kl.max() < self.kl_threshold)
+        return unconditional_scores
+
+    @property
+    def skipped_fraction(self):
+        return self.skipped_steps / max(self.total_steps, 1)
@@ -7,6 +7,11 @@ import re
 import random
 import uuid
 import copy
+import contextlib
+import hashlib
+import math
+import queue
+import threading
 from tqdm import tqdm
 from collections import Counter
 import argparse
@@ -17,13 +22,17 @@ import torchaudio
 from torchaudio.transforms import Resample
 import soundfile as sf
 from einops import rearrange
-from transformers import AutoTokenizer, AutoModelForCausalLM, LogitsProcessor, LogitsProcessorList, BitsAndBytesConfig
+from transformers import AutoTokenizer, AutoModelForCausalLM, LogitsProcessor, LogitsProcessorList, BitsAndBytesConfig, DynamicCache, StaticCache
+from transformers.generation.streamers import BaseStreamer
 from omegaconf import OmegaConf
 from codecmanipulator import CodecManipulator
 from mmtokenizer import _MMSentencePieceTokenizer
 from models.soundstream_hubert_new import SoundStream
 from vocoder import build_codec_model, process_audio
 from post_process_audio import replace_low_freq_with_energy_matched
+from kvcache import PrefixKVCache, PreallocatedCache, QuantizedKVCache, SegmentKVWindow
+from yue_engine import YuEEngine
+from guidance import GuidanceSchedule
 import re
 from sageattention import sageattn
 os.environ["CUDA_LAUNCH_BLOCKING"] = "1"
@@ -49,7 +58,8 @@ parser.add_argument("--quantization_stage1", type=str, default="bf16", choices=[
 parser.add_argument("--quantization_stage2", type=str, default="bf16", choices=["bf16", "int8", "int4", "nf4"], help="The quantization mode of the model stage 2.")
 parser.add_argument("--sage_attention", action="store_true", help="If set, the model will use SageAttention instead of the default scaled dot product attention.")
 parser.add_argument("--sdpa", action="store_true", help="If set, the model will use SageAttention instead of the default scaled dot product attention.")
-parser.add_argument("--compile", action="store_true", help="If set, the model will be compiled using Torch JIT.")
+parser.add_argument("--compile", action="store_true", help="If set, the decoding steps run as compiled static-shape steps: Stage 1 uses static KV caches sized for the context of a segment and its --max_new_tokens (for both CFG streams, instead of --kv_cache_dtype / --kv_cache_block_size) and the compiled step is reused across segments. Prefills stay eager. Uses SDPA attention.")
+parser.add_argument("--static_cache_length", type=int, default=None, help="The number of tokens the Stage 1 static KV caches of --compile can hold. By default, what each CFG stream can hold: the context limit of a segment plus --max_new_tokens (less the header for the unconditional stream).")
 # parser.add_argument("--temperature", type=float, default=1.0, help="The temperature value to use during generation.")
 parser.add_argument("--use_mmgp", action="store_true", help="If set, the model will use MMGP for inference.")
 parser.add_argument("--mmgp_profile", type=int, default=0, choices=[1, 2, 3, 4, 5], help="The MMGP profile to use for inference.")
@@ -70,6 +80,26 @@ parser.add_argument("--keep_intermediate", action="store_true", help="If set, in
 parser.add_argument("--disable_offload_model", action="store_true", help="If set, the model will not be offloaded from the GPU to CPU after Stage 1 inference.")
 parser.add_argument("--cuda_idx", type=int, default=0)
 parser.add_argument("--seed", type=int, default=42, help="An integer value to reproduce generation.")
+parser.add_argument("--restricted_lm_head", action="store_true", help="If set, the LM heads only compute logits for the tokens each stage can emit (codebook 0 and <EOA> for Stage 1, codebooks 1-7 for Stage 2) instead of the whole vocabulary. Stage 1 samples from the same distribution only with --repetition_penalty 1.0: the classifier-free guidance scores are then normalized over those tokens only, which shifts them by a constant that the repetition penalty is not invariant to.")
+parser.add_argument("--prompt_lookup_num_tokens", type=int, default=0, help="If > 0, Stage 1 uses prompt lookup speculative decoding: up to this many tokens are drafted from repeated n-grams of the context (e.g. an audio prompt or an earlier chorus) and verified in one forward pass. The sampling distribution is unchanged. Only used with --num_candidates 1.")
+parser.add_argument("--prompt_lookup_ngram_size", type=int, default=3, help="The longest n-gram matched against the context by --prompt_lookup_num_tokens.")
+parser.add_argument("--pipeline_stage2", action="store_true", help="If set, Stage 2 decodes every 6s chunk in a background thread as soon as Stage 1 has generated it, instead of waiting for Stage 1 to finish. Both models have to fit in GPU memory (not used with --use_mmgp nor --compile). The decoded chunks are saved with the Stage 1 checkpoint, so that --resume_job_dir does not decode them again.")
+parser.add_argument("--resume_job_dir", type=str, default="", help="The --output_dir of an interrupted job to continue (not to be confused with --resume_path, the xcodec checkpoint). Stage 1 restarts after the last checkpointed lyric segment and Stage 2 after the last checkpointed batch of chunks.")
+parser.add_argument("--checkpoint_kv_cache", action="store_true", help="If set, the Stage 1 checkpoint also stores the KV caches, so that a resumed job does not have to prefill the song generated so far again. This can take several GB.")
+parser.add_argument("--context_policy", type=str, default="evict_segments", choices=["evict_segments", "truncate"], help="What Stage 1 does when the song outgrows the context: 'evict_segments' drops the oldest lyric segments from the KV caches in place and keeps the instruction and audio reference, 'truncate' keeps the last tokens only and prefills them again.")
+parser.add_argument("--kv_cache_block_size", type=int, default=1024, help="The Stage 1 KV caches reserve memory in blocks of this many tokens and write new tokens in place. 0 uses a DynamicCache that is reallocated on every token.")
+parser.add_argument("--fused_sampler", action="store_true", help="If set, Stage 1 applies temperature, top-k and top-p and samples in one step over the candidate tokens only (Gumbel-max sampling) instead of sorting the whole vocabulary. The sampling distribution is unchanged, the random draws differ from the default sampler.")
+parser.add_argument("--repetition_penalty_window", type=int, default=0, help="If > 0, the Stage 1 repetition penalty only applies to tokens among the last this many tokens of the context instead of the whole context.")
+parser.add_argument("--prefill_chunk_size", type=int, default=0, help="If > 0, Stage 1 prompts are prefilled into the KV cache in blocks of this many tokens, which bounds the peak activation memory of long (e.g. audio prompted) contexts. 0 prefills the whole prompt in one forward pass.")
+parser.add_argument("--kv_cache_dtype", type=str, default="bf16", choices=["bf16", "int8"], help="Storage of the Stage 1 KV caches. int8 quantizes keys and values per token and head on write, halving the cache memory (check the quality with evals/kv_cache).")
+parser.add_argument("--cfg_schedule", type=str, default="always", choices=["always", "first_n", "every_k", "kl"], help="When Stage 1 runs the unconditional (classifier-free guidance) pass: 'always' on every token, 'first_n' for the first --cfg_schedule_steps tokens of every segment, 'every_k' on every --cfg_schedule_steps-th token (the tokens in between reuse its scores), 'kl' until the KL divergence between the conditional and unconditional distributions has stayed below --cfg_kl_threshold for --cfg_schedule_steps tokens. The skipped passes save up to half of the Stage 1 layer evaluations at a small quality risk.")
+parser.add_argument("--cfg_schedule_steps", type=int, default=500, help="The number of tokens of --cfg_schedule 'first_n', the period of 'every_k' and the window of 'kl'.")
+parser.add_argument("--cfg_kl_threshold", type=float, default=0.05, help="The KL divergence below which --cfg_schedule 'kl' drops the unconditional pass.")
+parser.add_argument("--prefix_cache_dir", type=str, default="", help="If set, the prefilled Stage 1 KV cache of the header (instruction and audio reference) is stored in this directory, keyed by its tokens and the model, and later jobs with the same header (seed sweeps, re-runs, ...) load it instead of prefilling it again.")
+parser.add_argument("--prefix_cache_memory_mb", type=int, default=2048, help="The memory the in-process tier of --prefix_cache_dir may use for the most recently used headers.")
+parser.add_argument("--codec_cache_dir", type=str, default="", help="If set, the xcodec codes of audio prompts are cached in this directory, keyed by the content of the audio file, the codec checkpoint and the bandwidth. Jobs that reuse a reference track load its codes without decoding or encoding the audio.")
+parser.add_argument("--engine", type=str, default="hf", choices=["hf", "yue"], help="The decoding loop of both stages. 'hf' uses the patched transformers generate (see patchtransformers.sh), 'yue' the standalone engine of yue_engine.py, which runs the same models on a stock transformers install. Prompt lookup decoding, --fused_sampler and --compile need 'hf'.")
+parser.add_argument("--num_candidates", type=int, default=1, help="The number of independent Stage 1 candidates sampled together as one batch. Candidate k uses seed + k and gets its own _vtrack/_itrack pair.")
 # Config for xcodec and upsampler
 parser.add_argument('--basic_model_config', default='./xcodec_mini_infer/final_ckpt/config.yaml', help='YAML files for xcodec configurations.')
 parser.add_argument('--resume_path', default='./xcodec_mini_infer/final_ckpt/ckpt_00360000.pth', help='Path to the xcodec checkpoint.')
@@ -82,17 +112,35 @@ parser.add_argument('-r', '--rescale', action='store_true', help='Rescale output
 args = parser.parse_args()
 if args.use_audio_prompt and not args.audio_prompt_path:
     raise FileNotFoundError("Please offer audio prompt filepath using '--audio_prompt_path', when you enable 'use_audio_prompt'!")
+if args.resume_job_dir:
+    args.output_dir = args.resume_job_dir
+if args.pipeline_stage2 and args.use_mmgp:
+    print("--pipeline_stage2 needs both models resident on the GPU, it is ignored with --use_mmgp.")
+    args.pipeline_stage2 = False
+if args.pipeline_stage2 and args.compile:
+    print("--pipeline_stage2 would compile the Stage 2 step in its thread while Stage 1 runs compiled steps (torch.compile is not thread-safe), it is ignored with --compile.")
+    args.pipeline_stage2 = False
 if args.use_dual_tracks_prompt and not args.vocal_track_prompt_path and not args.instrumental_track_prompt_path:
     raise FileNotFoundError("Please offer dual tracks prompt filepath using '--vocal_track_prompt_path' and '--inst_decoder_path', when you enable '--use_dual_tracks_prompt'!")
+if args.engine == "yue" and args.compile:
+    raise ValueError("--compile runs the compiled steps of the patched transformers generate, it cannot be used with '--engine yue'.")
+if args.engine == "yue" and (args.prompt_lookup_num_tokens > 0 or args.fused_sampler):
+    raise ValueError("--prompt_lookup_num_tokens and --fused_sampler are implemented by the patched transformers generate, they cannot be used with '--engine yue'.")
+if args.restricted_lm_head and args.repetition_penalty != 1.0:
+    print(f"--restricted_lm_head with --repetition_penalty {args.repetition_penalty}: the guided Stage 1 scores are normalized over the codebook 0 tokens only, so the penalty (not invariant to that shift) slightly changes the sampling distribution. Use --repetition_penalty 1.0 for the same distribution as the full LM head.")
 stage1_model = args.stage1_model
 stage2_model = args.stage2_model
 tokenizer_path = args.tokenizer
 cuda_idx = args.cuda_idx
 max_new_tokens = args.max_new_tokens
+# the context (cached segments and the new prompt) is cut so that it fits in 16384 tokens with the generated ones
+max_context = 16384-max_new_tokens-1
 stage1_output_dir = os.path.join(args.output_dir, f"stage1")
 stage2_output_dir = stage1_output_dir.replace('stage1', 'stage2')
+checkpoint_dir = os.path.join(args.output_dir, "checkpoint")
 os.makedirs(stage1_output_dir, exist_ok=True)
 os.makedirs(stage2_output_dir, exist_ok=True)
+os.makedirs(checkpoint_dir, exist_ok=True)
 quantization_stage1 = args.quantization_stage1
 quantization_stage2 = args.quantization_stage2
 sage_attention = args.sage_attention
@@ -109,7 +157,8 @@ compile = args.compile
 device = torch.device(f"cuda:{cuda_idx}" if torch.cuda.is_available() else "cpu")
 mmtokenizer = _MMSentencePieceTokenizer(tokenizer_path)
 
-if use_sdpa:
+# the 4D masks of the static caches used by --compile need SDPA
+if use_sdpa or compile:
     attn_implementation="sdpa"
 else:
     attn_implementation="flash_attention_2"
@@ -124,7 +173,7 @@ def set_seed(seed=42):
     torch.backends.cudnn.benchmark = False  # Disables benchmarking for consistency
 
 
-def load_optimized_model(model_path, quantization, attention, use_mmgp=False, compile=False):
+def load_optimized_model(model_path, quantization, attention, use_mmgp=False):
     bnb_config = None
     torch_dtype = torch.bfloat16
     
@@ -146,13 +195,10 @@ def load_optimized_model(model_path, quantization, attention, use_mmgp=False, co
         attn_implementation=attention
     )
     
-    if use_mmgp:
-        return model
-    
-    return torch.compile(model, mode="max-autotune") if compile else model
+    return model
 
 set_seed(seed)
-model = load_optimized_model(stage1_model, quantization_stage1, attn_implementation, use_mmgp, compile)
+model = load_optimized_model(stage1_model, quantization_stage1, attn_implementation, use_mmgp)
 
 if use_mmgp:
     model.to("cpu")
@@ -163,7 +209,7 @@ model.eval()
 
 print("Stage 2 inference...")
 
-model_stage2 = load_optimized_model(stage2_model, quantization_stage2, attn_implementation, use_mmgp, compile)
+model_stage2 = load_optimized_model(stage2_model, quantization_stage2, attn_implementation, use_mmgp)
 
 if use_mmgp:
     model_stage2.to("cpu")
@@ -181,10 +227,19 @@ if use_mmgp:
         kwargs["budgets"] =  5000
 
     quantizeTransformer = mmgp_profile == 3 or mmgp_profile == 4 or mmgp_profile == 5 
-    offload.profile(pipe, profile_no = mmgp_profile,  compile = compile, quantizeTransformer= quantizeTransformer,  verboseLevel= 1, **kwargs )
+    # --compile runs the compiled decoding steps of `generate` / `stage2_generate_chunks`, mmgp does not compile again
+    offload.profile(pipe, profile_no = mmgp_profile,  compile = False, quantizeTransformer= quantizeTransformer,  verboseLevel= 1, **kwargs )
+
+if args.engine == "yue":
+    model = YuEEngine(model)
+    model_stage2 = YuEEngine(model_stage2)
 
 codectool = CodecManipulator("xcodec", 0, 1)
 codectool_stage2 = CodecManipulator("xcodec", 0, 8)
+if args.restricted_lm_head:
+    # Stage 1 emits xcodec codebook 0 tokens and <EOA>, Stage 2 the tokens of codebooks 1 to 7
+    model.set_output_token_ids([mmtokenizer.eoa] + list(range(45334, 46358)))
+    model_stage2.set_output_token_ids(list(range(46358, 53526)))
 model_config = OmegaConf.load(args.basic_model_config)
 codec_model = eval(model_config.generator.name)(**model_config.generator.config).to(device)
 parameter_dict = torch.load(args.resume_path, map_location='cpu', weights_only=False)
@@ -192,22 +247,109 @@ codec_model.load_state_dict(parameter_dict['codec_model'])
 codec_model.to(device)
 codec_model.eval()
 
-class BlockTokenRangeProcessor(LogitsProcessor):
-    def __init__(self, start_id, end_id):
-        self.blocked_token_ids = list(range(start_id, end_id))
+# Vocabulary masks shared by every VocabRangeProcessor, keyed by (allowed, blocked, vocab_size, device)
+_vocab_masks = {}
+
+class VocabRangeProcessor(LogitsProcessor):
+    """Restricts sampling to token id ranges.
+
+    `allowed` and `blocked` are sequences of half-open (start_id, end_id) ranges. If `allowed` is given, every
+    token outside of it is blocked; `blocked` ranges are removed on top of that. The boolean mask is built once
+    on the scores' device and applied with a single in-place fill on every step.
+    """
+    def __init__(self, allowed=None, blocked=()):
+        self.allowed = None if allowed is None else tuple((int(start), int(end)) for start, end in allowed)
+        self.blocked = tuple((int(start), int(end)) for start, end in blocked)
+
+    def get_mask(self, vocab_size, device):
+        key = (self.allowed, self.blocked, vocab_size, torch.device(device))
+        mask = _vocab_masks.get(key)
+        if mask is None:
+            mask = torch.zeros(vocab_size, dtype=torch.bool, device=device)
+            if self.allowed is not None:
+                mask.fill_(True)
+                for start, end in self.allowed:
+                    mask[start:end] = False
+            for start, end in self.blocked:
+                mask[start:end] = True
+            _vocab_masks[key] = mask
+        return mask
+
+    def __call__(self, input_ids, scores):
+        return scores.masked_fill_(self.get_mask(scores.shape[-1], scores.device), -float("inf"))
+
+class IncrementalRepetitionPenaltyProcessor(LogitsProcessor):
+    """Repetition penalty (as `repetition_penalty` of `generate`) with running token counts.
+
+    The counts of the context are built on the first call and then only updated with the tokens appended since the
+    previous call, so the per step cost does not grow with the context. If `window` > 0 only the last `window` tokens
+    are penalized. With `output_token_ids` (a restricted LM head) the processor works on the compact scores directly.
+    The state belongs to one sequence, so a new instance is needed for every `generate` call.
+    """
+    def __init__(self, penalty, vocab_size, window=0, output_token_ids=None):
+        # read by `_get_restricted_vocab_processor` of the patched transformers
+        self.compact_scores = output_token_ids is not None
+        self.penalty = penalty
+        self.window = window
+        self.vocab_size = vocab_size
+        self.output_token_ids = output_token_ids
+        self.counts = None
+        self.length = 0
+
+    def _columns(self, token_ids):
+        # tokens that have no column in the (compact) scores are counted in an extra column
+        if self.output_token_ids is None:
+            return token_ids
+        return self.token_columns[token_ids]
+
+    def _count(self, token_ids, value):
+        if token_ids.shape[-1] > 0:
+            columns = self._columns(token_ids)
+            self.counts.scatter_add_(1, columns, torch.full_like(columns, value, dtype=self.counts.dtype))
 
     def __call__(self, input_ids, scores):
-        scores[:, self.blocked_token_ids] = -float("inf")
-        return scores
+        if self.counts is None:
+            num_columns = scores.shape[-1] + 1
+            self.counts = torch.zeros((input_ids.shape[0], num_columns), dtype=torch.int32, device=scores.device)
+            if self.output_token_ids is not None:
+                output_token_ids = self.output_token_ids.to(scores.device)
+                self.token_columns = torch.full((self.vocab_size,), num_columns - 1, dtype=torch.long, device=scores.device)
+                self.token_columns[output_token_ids] = torch.arange(output_token_ids.shape[0], device=scores.device)
+        length = input_ids.shape[-1]
+        start = max(self.length - self.window, 0) if self.window > 0 else 0
+        new_start = max(length - self.window, 0) if self.window > 0 else 0
+        self._count(input_ids[:, max(self.length, new_start) :], 1)
+        self._count(input_ids[:, start : min(new_start, self.length)], -1)
+        self.length = length
+
+        penalized = self.counts[:, :-1] > 0
+        penalized_scores = torch.where(scores < 0, scores * self.penalty, scores / self.penalty)
+        return torch.where(penalized, penalized_scores, scores)
+
+# `Resample` modules (which hold the resampling kernel) keyed by (orig_freq, new_freq)
+_resamplers = {}
+
+# Audio loaded on both sides of an audio prompt window (seconds), so that the xcodec encoder sees the context of the
+# first and last frames of the window
+AUDIO_WINDOW_MARGIN = 1.0
 
-def load_audio_mono(filepath, sampling_rate=16000):
-    audio, sr = torchaudio.load(filepath)
+def load_audio_mono(filepath, sampling_rate=16000, start_time=0.0, end_time=None):
+    """Loads [start_time, end_time) seconds of `filepath` (to the end if `end_time` is None) as mono audio at `sampling_rate`."""
+    if start_time > 0 or end_time is not None:
+        # only the window is decoded
+        sr = torchaudio.info(filepath).sample_rate
+        frame_offset = round(start_time * sr)
+        num_frames = -1 if end_time is None else max(round(end_time * sr) - frame_offset, 0)
+        audio, sr = torchaudio.load(filepath, frame_offset=frame_offset, num_frames=num_frames)
+    else:
+        audio, sr = torchaudio.load(filepath)
     # Convert to mono
     audio = torch.mean(audio, dim=0, keepdim=True)
     # Resample if needed
     if sr != sampling_rate:
-        resampler = Resample(orig_freq=sr, new_freq=sampling_rate)
-        audio = resampler(audio)
+        if (sr, sampling_rate) not in _resamplers:
+            _resamplers[(sr, sampling_rate)] = Resample(orig_freq=sr, new_freq=sampling_rate)
+        audio = _resamplers[(sr, sampling_rate)](audio)
     return audio
 
 def encode_audio(codec_model, audio_prompt, device, target_bw=0.5):
@@ -219,12 +361,384 @@ def encode_audio(codec_model, audio_prompt, device, target_bw=0.5):
     raw_codes = raw_codes.cpu().numpy().astype(np.int16)
     return raw_codes
 
+def codec_cache_key(filepath, target_bw, first_frame=0, end_time=None):
+    """Hash of the content of `filepath`, the xcodec checkpoint (path, size and modification time), `target_bw` and
+    the encoded window."""
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    for path in (args.resume_path, args.basic_model_config):
+        stat = os.stat(path)
+        digest.update(f"|{os.path.realpath(path)}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+    digest.update(f"|{target_bw}|{first_frame}|{end_time}".encode())
+    return digest.hexdigest()
+
+def encode_audio_files(codec_model, filepaths, device, target_bw=0.5, start_time=0.0, end_time=None):
+    """`encode_audio` of the mono 16 kHz audio of every file of `filepaths`, encoded together in one batch.
+
+    Only the window [start_time, end_time) seconds, widened by AUDIO_WINDOW_MARGIN, is loaded and encoded. Returns
+    the (1, n_q, frames) codes of every file and the index of their first frame in the codes of the whole file. With
+    --codec_cache_dir the int16 codes are stored as npy and a later call with the same file and window loads them
+    memory-mapped without loading the audio.
+    """
+    # the window starts on a 50 Hz xcodec frame, so that its frames line up with those of the whole file
+    first_frame = math.floor(max(start_time - AUDIO_WINDOW_MARGIN, 0) * 50)
+    window_end = None if end_time is None else end_time + AUDIO_WINDOW_MARGIN
+    codes = [None] * len(filepaths)
+    cache_paths = [None] * len(filepaths)
+    if args.codec_cache_dir:
+        for i, filepath in enumerate(filepaths):
+            cache_paths[i] = os.path.join(args.codec_cache_dir, f"{codec_cache_key(filepath, target_bw, first_frame, window_end)}.npy")
+            if os.path.exists(cache_paths[i]):
+                codes[i] = np.load(cache_paths[i], mmap_mode="r")
+    missing = [i for i, file_codes in enumerate(codes) if file_codes is None]
+    if missing:
+        audios = [load_audio_mono(filepaths[i], start_time=first_frame / 50, end_time=window_end) for i in missing]
+        lengths = [audio.shape[-1] for audio in audios]
+        batch = torch.zeros(len(audios), 1, max(lengths))
+        for row, audio in enumerate(audios):
+            batch[row, :, : audio.shape[-1]] = audio
+        raw_codes = encode_audio(codec_model, batch, device, target_bw=target_bw)
+        for row, i in enumerate(missing):
+            # the frames of the zero padding of shorter files are dropped
+            num_frames = -(-lengths[row] * raw_codes.shape[-1] // batch.shape[-1])
+            codes[i] = np.ascontiguousarray(raw_codes[row : row + 1, :, :num_frames])
+            if cache_paths[i] is not None:
+                os.makedirs(args.codec_cache_dir, exist_ok=True)
+                save_atomic(cache_paths[i], lambda f: np.save(f, codes[i]))
+    return codes, first_frame
+
 def split_lyrics(lyrics):
     pattern = r"\[(\w+)\](.*?)(?=\[|\Z)"
     segments = re.findall(pattern, lyrics, re.DOTALL)
     structured_lyrics = [f"[{seg[0]}]\n{seg[1].strip()}\n\n" for seg in segments]
     return structured_lyrics
 
+def save_atomic(path, save_fn):
+    """Writes `path` with `save_fn(file)` through a temporary file, so that an interrupted job never leaves a partial file."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        save_fn(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def static_cache_length(unconditional=False):
+    """The number of tokens a Stage 1 static cache of the conditional (or unconditional) CFG stream has to hold.
+
+    The conditional stream holds at most `max_context` tokens and the ones generated for the segment (with the prompt
+    lookup drafts). The unconditional stream holds no header and only the last prompt token of each kept segment, its
+    cache is sized once `kv_window.header_length` is known.
+    """
+    if args.static_cache_length is not None:
+        return args.static_cache_length
+    length = max_context + max_new_tokens + args.prompt_lookup_num_tokens
+    return length - kv_window.header_length if unconditional else length
+
+def new_kv_cache(unconditional=False):
+    """Creates an empty Stage 1 KV cache of the conditional (or unconditional) CFG stream."""
+    if compile:
+        # `generate` runs compiled decoding steps with static caches
+        return StaticCache(
+            model.config,
+            max_batch_size=args.num_candidates,
+            max_cache_len=static_cache_length(unconditional),
+            device=device,
+            dtype=model.dtype,
+        )
+    if args.kv_cache_dtype == "int8":
+        return QuantizedKVCache(max(args.kv_cache_block_size, 1))
+    if args.kv_cache_block_size > 0:
+        return PreallocatedCache(args.kv_cache_block_size)
+    return DynamicCache()
+
+def cache_to_device(cache, device, into=None):
+    """Copies the entries of `cache` to `device` (e.g. "cpu" for a checkpoint), into a new DynamicCache or `into`."""
+    into = DynamicCache() if into is None else into
+    # a static cache holds its tokens followed by unused slots
+    length = cache.get_seq_length()
+    cache_position = torch.arange(length, device=device)
+    for layer_idx, (keys, values) in enumerate(zip(cache.key_cache, cache.value_cache)):
+        keys, values = keys[:, :, :length].to(device), values[:, :, :length].to(device)
+        into.update(keys, values, layer_idx, {"cache_position": cache_position})
+    return into
+
+def prefill_shared_prompt(model, prompt_ids, num_rows, into=None, prefix_length=0):
+    """Prefill `prompt_ids` (1, seq_len) once and repeat the resulting KV cache for `num_rows` batch rows.
+
+    The first `prefix_length` tokens are loaded from `prefix_cache` when it holds them, otherwise they are stored in it
+    once prefilled. If `into` is a StaticCache (--compile), the repeated entries are copied into it.
+    """
+    past_key_values = DynamicCache() if isinstance(into, StaticCache) else new_kv_cache()
+    chunk_size = args.prefill_chunk_size if args.prefill_chunk_size > 0 else prompt_ids.shape[-1]
+    prefix_ids = prompt_ids[:, :prefix_length]
+    cached_prefix = prefix_cache is not None and prefix_length > 0 and prefix_cache.load(prefix_ids, past_key_values)
+    start = past_key_values.get_seq_length()
+    with torch.no_grad():
+        while start < prompt_ids.shape[-1]:
+            end = min(start + chunk_size, prompt_ids.shape[-1])
+            if prefix_cache is not None and not cached_prefix and start < prefix_length:
+                # the prefix is stored as soon as it has been prefilled
+                end = min(end, prefix_length)
+            model(input_ids=prompt_ids[:, start:end], past_key_values=past_key_values, use_cache=True, num_logits_to_keep=1)
+            if prefix_cache is not None and not cached_prefix and end == prefix_length:
+                prefix_cache.store(prefix_ids, past_key_values)
+            start = end
+    if num_rows > 1:
+        past_key_values.batch_repeat_interleave(num_rows)
+    if isinstance(into, StaticCache):
+        past_key_values = cache_to_device(past_key_values, prompt_ids.device, into=into)
+    return past_key_values
+
+# Stage 2 static caches of --compile keyed by (rows, length), reset and reused by every batch
+_stage2_caches = {}
+
+def stage2_generate(model, prompt, batch_size=16):
+    """Stage 2 of `prompt` (1, frames): `batch_size` chunks of 300 frames decoded as one batch, or the whole prompt as
+    a single row if `batch_size` is 1. Returns the concatenated outputs."""
+    if batch_size > 1:
+        chunks = [prompt[:, i * 300:(i + 1) * 300] for i in range(batch_size)]
+    else:
+        chunks = [prompt]
+    return np.concatenate(stage2_generate_chunks(model, chunks))
+
+def stage2_generate_chunks(model, chunks):
+    """Stage 2 of a batch of Stage 1 chunks, each a (1, frames) array of codebook 0 codes. Returns the (frames * 8,)
+    output of every chunk.
+
+    Chunks may have different lengths (e.g. the last, shorter chunk of a track): the prompts are left-padded, and
+    after its last frame a shorter row keeps being fed its last codebook 0 token, the outputs of those frames are
+    dropped. With --compile every batch is padded to --stage2_batch_size rows of at least 300 frames (the padding
+    rows repeat the last chunk), so that the compiled step and its static cache keep the same shapes.
+    """
+    codec_ids = [
+        codectool.offset_tok_ids(
+            codectool.unflatten(chunk, n_quantizer=1),
+            global_offset=codectool.global_offset,
+            codebook_size=codectool.codebook_size,
+            num_codebooks=codectool.num_codebooks,
+        ).astype(np.int32)[0]
+        for chunk in chunks
+    ]
+    num_frames = [ids.shape[-1] for ids in codec_ids]
+    num_rows, max_frames = len(chunks), max(num_frames)
+    if compile:
+        num_rows, max_frames = max(num_rows, args.stage2_batch_size), max(max_frames, 300)
+        codec_ids = codec_ids + [codec_ids[-1]] * (num_rows - len(chunks))
+    len_prompt = max_frames + 3
+    prompt_ids = np.full((num_rows, len_prompt), mmtokenizer.eoa, dtype=np.int32)
+    prompt_mask = np.zeros((num_rows, len_prompt), dtype=np.int64)
+    for row, ids in enumerate(codec_ids):
+        row_prompt = np.concatenate([[mmtokenizer.soa, mmtokenizer.stage_1], ids, [mmtokenizer.stage_2]])
+        prompt_ids[row, len_prompt - len(row_prompt):] = row_prompt
+        prompt_mask[row, len_prompt - len(row_prompt):] = 1
+
+    codec_ids = torch.as_tensor(np.stack([np.pad(ids, (0, max_frames - len(ids)), mode="edge") for ids in codec_ids])).to(device)
+    prompt_ids = torch.as_tensor(prompt_ids).to(device)
+    max_cache_len = len_prompt + max_frames * 8
+    # Padded rows need an attention mask and explicit positions. The mask covers the whole cache (the causal mask
+    # hides the future slots), so that the compiled steps see the same shapes on every step.
+    attention_mask = position_ids = None
+    if compile or min(num_frames) < max_frames:
+        attention_mask = torch.ones((num_rows, max_cache_len), dtype=torch.long, device=device)
+        attention_mask[:, :len_prompt] = torch.as_tensor(prompt_mask)
+        position_ids = (attention_mask.cumsum(-1) - 1).masked_fill_(attention_mask == 0, 1)
+    
+    block_list = LogitsProcessorList([VocabRangeProcessor(allowed=[(46358, 53526)])])
+
+    # Teacher forcing decode loop: a single KV cache lives for the whole chunk. Each frame feeds its cb0 token
+    # (together with the last residual token of the previous frame) and decodes the 7 residual codebooks
+    # incrementally, so the prompt is prefilled only once.
+    # With --compile the cache is static and the decoding steps (all but the prefill) run compiled
+    model_step = model
+    if compile:
+        if (num_rows, max_cache_len) not in _stage2_caches:
+            _stage2_caches[num_rows, max_cache_len] = StaticCache(
+                model.config,
+                max_batch_size=num_rows,
+                max_cache_len=max_cache_len,
+                device=device,
+                dtype=model.dtype,
+            )
+        past_key_values = _stage2_caches[num_rows, max_cache_len]
+        past_key_values.reset()
+    else:
+        past_key_values = DynamicCache()
+    past_length = 0
+    step_ids = prompt_ids
+    with torch.no_grad():
+        for frames_idx in range(max_frames):
+            cb0 = codec_ids[:, frames_idx:frames_idx+1]
+            prompt_ids = torch.cat([prompt_ids, cb0], dim=1)
+            step_ids = torch.cat([step_ids, cb0], dim=1)
+            for _ in range(7):
+                step_end = past_length + step_ids.shape[1]
+                cache_position = torch.arange(past_length, step_end, device=device)
+                mask_kwargs = {}
+                if attention_mask is not None:
+                    mask_kwargs = {
+                        "attention_mask": attention_mask if compile else attention_mask[:, :step_end],
+                        "position_ids": position_ids[:, past_length:step_end],
+                    }
+                logits = model_step(
+                    input_ids=step_ids,
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                    cache_position=cache_position,
+                    num_logits_to_keep=1,
+                    **mask_kwargs,
+                ).logits[:, -1, :].float()
+                past_length = step_end
+                if compile and model_step is model:
+                    model_step = model.get_compiled_call(model.generation_config.compile_config)
+                if model.output_token_ids is not None:
+                    next_tokens = model.output_token_ids[torch.argmax(logits, dim=-1)]
+                else:
+                    next_tokens = torch.argmax(block_list(prompt_ids, logits), dim=-1)
+                step_ids = next_tokens[:, None]
+                prompt_ids = torch.cat([prompt_ids, step_ids], dim=1)
+
+    output = prompt_ids.cpu().numpy()[:, len_prompt:]
+    return [output[row, :frames * 8] for row, frames in enumerate(num_frames)]
+
+def stage2_inference(model, stage1_output_set, stage2_output_dir, batch_size=4, ready_chunks=None):
+    # `ready_chunks` maps a Stage 1 npy path to the 6s chunks already decoded while Stage 1 was running
+    ready_chunks = ready_chunks or {}
+    # The 6s chunks of every track (vocal and instrumental, of every candidate) that are not decoded yet form one
+    # work pool, which is decoded batch_size chunks at a time. The shorter ending of a track is its last chunk, it
+    # shares a batch with full chunks. Decoded chunks are checkpointed per track after every batch.
+    tracks = []
+    for stage1_path in stage1_output_set:
+        output_filename = os.path.join(stage2_output_dir, os.path.basename(stage1_path))
+        if os.path.exists(output_filename):
+            print(f'{output_filename} stage2 has done.')
+            tracks.append({"output_filename": output_filename})
+            continue
+
+        # Load the prompt
+        prompt = np.load(stage1_path).astype(np.int32)
+
+        # 6s chunks, the last one holds the remaining frames
+        num_chunks = -(-prompt.shape[-1] // 300)
+
+        chunks = dict(ready_chunks.get(stage1_path, {}))
+        chunks_checkpoint = os.path.join(checkpoint_dir, os.path.basename(stage1_path) + ".stage2.pt")
+        if os.path.exists(chunks_checkpoint):
+            chunks.update(torch.load(chunks_checkpoint, weights_only=False))
+        tracks.append({
+            "output_filename": output_filename,
+            "prompt": prompt,
+            "num_chunks": num_chunks,
+            "chunks": chunks,
+            "chunks_checkpoint": chunks_checkpoint,
+        })
+    pending = [
+        (track, chunk)
+        for track in tracks if "prompt" in track
+        for chunk in range(track["num_chunks"]) if chunk not in track["chunks"]
+    ]
+    # the shorter endings go last, so that they do not pad batches of full chunks more than needed
+    pending.sort(key=lambda job: job[0]["prompt"].shape[-1] < (job[1] + 1) * 300)
+    for start in tqdm(range(0, len(pending), batch_size), desc="Stage2 inference..."):
+        batch = pending[start:start + batch_size]
+        segments = stage2_generate_chunks(model, [track["prompt"][:, chunk * 300:(chunk + 1) * 300] for track, chunk in batch])
+        for (track, chunk), segment in zip(batch, segments):
+            track["chunks"][chunk] = segment
+        for track in {id(track): track for track, _ in batch}.values():
+            save_atomic(track["chunks_checkpoint"], lambda f: torch.save(track["chunks"], f))
+
+    stage2_result = []
+    for track in tracks:
+        output_filename = track["output_filename"]
+        if "prompt" not in track:
+            stage2_result.append(output_filename)
+            continue
+        num_chunks = track["num_chunks"]
+        output = np.concatenate([track["chunks"][chunk] for chunk in range(num_chunks)]) if num_chunks else np.zeros(0, dtype=np.int64)
+        output = codectool_stage2.ids2npy(output)
+
+        # Fix invalid codes (a dirty solution, which may harm the quality of audio)
+        # We are trying to find better one
+        fixed_output = copy.deepcopy(output)
+        for i, line in enumerate(output):
+            for j, element in enumerate(line):
+                if element < 0 or element > 1023:
+                    counter = Counter(line)
+                    most_frequant = sorted(counter.items(), key=lambda x: x[1], reverse=True)[0][0]
+                    fixed_output[i, j] = most_frequant
+        # save output
+        save_atomic(output_filename, lambda f: np.save(f, fixed_output))
+        if os.path.exists(track["chunks_checkpoint"]):
+            os.remove(track["chunks_checkpoint"])
+        stage2_result.append(output_filename)
+    return stage2_result
+
+class Stage2ChunkStreamer(BaseStreamer):
+    """Follows the Stage 1 tokens of every candidate as they are generated and puts each 6s chunk (300 frames) of
+    the vocal and instrumental tracks in `chunk_queue` as soon as it is complete.
+
+    Frames are counted like the Stage 1 post-processing does: a segment ends at its first <EOA> and an unpaired
+    last token is dropped.
+    """
+    def __init__(self, chunk_queue, num_rows):
+        self.chunk_queue = chunk_queue
+        self.frames = [{"vtrack": [], "itrack": []} for _ in range(num_rows)]
+        self.pending = [None] * num_rows
+        self.ended = [False] * num_rows
+        self.is_prompt = True
+
+    def put(self, value):
+        if self.is_prompt:
+            # the first call of every `generate` carries the prompt of a new segment
+            self.is_prompt = False
+            self.pending = [None] * len(self.frames)
+            self.ended = [False] * len(self.frames)
+            return
+        for row, token in enumerate(value.tolist()):
+            if self.ended[row]:
+                continue
+            if token == mmtokenizer.eoa:
+                self.ended[row] = True
+            elif self.pending[row] is None:
+                self.pending[row] = token
+            else:
+                frames = self.frames[row]
+                frames["vtrack"].append(self.pending[row])
+                frames["itrack"].append(token)
+                self.pending[row] = None
+                if len(frames["vtrack"]) % 300 == 0:
+                    chunk = len(frames["vtrack"]) // 300 - 1
+                    for track in ("vtrack", "itrack"):
+                        self.chunk_queue.put((row, track, chunk, codectool.ids2npy(np.array(frames[track][-300:]))))
+
+    def end(self):
+        self.is_prompt = True
+
+def stage2_worker(model, chunk_queue, results, batch_size):
+    """Runs Stage 2 on the chunks of `chunk_queue` until it gets None, batching up to `batch_size` ready chunks.
+    Outputs are stored in `results[(row, track, chunk)]`, an exception in `results["error"]`."""
+    stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+    finished = False
+    try:
+        while not finished:
+            jobs = [chunk_queue.get()]
+            while len(jobs) < batch_size and jobs[-1] is not None and not chunk_queue.empty():
+                jobs.append(chunk_queue.get_nowait())
+            if jobs[-1] is None:
+                jobs.pop()
+                finished = True
+            if not jobs:
+                continue
+            prompt = np.concatenate([codes for _, _, _, codes in jobs], axis=1)
+            # a side stream lets the Stage 2 kernels run next to the Stage 1 decode steps
+            with torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+                output = stage2_generate(model, prompt, batch_size=len(jobs))
+            for k, (row, track, chunk, _) in enumerate(jobs):
+                results[(row, track, chunk)] = output[k * 300 * 8:(k + 1) * 300 * 8]
+    except Exception as e:
+        results["error"] = e
+
 # Call the function and print the result
 stage1_output_set = []
 # Tips:
@@ -251,29 +765,102 @@ start_of_segment = mmtokenizer.tokenize('[start_of_segment]')
 end_of_segment = mmtokenizer.tokenize('[end_of_segment]')
 # Format text prompt
 run_n_segments = min(args.run_n_segments+1, len(lyrics))
+# Candidates are the rows of one batch, each sampled from its own RNG stream
+num_candidates = args.num_candidates
+generators = None
+if num_candidates > 1:
+    generators = [torch.Generator(device=device).manual_seed(seed + k) for k in range(num_candidates)]
+# KV caches of everything generated so far (conditional and unconditional CFG streams), carried across segments
+# so that only the new prompt is prefilled
+past_key_values = new_kv_cache()
+# created before the first `generate` call, once the header is known
+unconditional_past_key_values = None
+unconditional_attention_mask = None
+# Tokens the KV caches stand for: the header followed by the segments that have not been evicted
+context_ids = None
+context_mask = None
+kv_window = SegmentKVWindow(model.model.rotary_emb.inv_freq)
+# the cached states depend on the weights and the format of the Stage 1 caches
+prefix_cache = None
+if args.prefix_cache_dir:
+    prefix_cache = PrefixKVCache(
+        f"{stage1_model}|{quantization_stage1}|{attn_implementation}|{'bf16' if compile else args.kv_cache_dtype}",
+        args.prefix_cache_dir,
+        args.prefix_cache_memory_mb * 2**20,
+    )
+guidance_schedule = GuidanceSchedule(args.cfg_schedule, args.cfg_schedule_steps, args.cfg_kl_threshold)
+# Stage 1 is checkpointed after every lyric segment
+stage1_checkpoint = os.path.join(checkpoint_dir, "stage1.pt")
+resume_segment = 0
+# Stage 2 outputs of the chunks decoded by --pipeline_stage2, keyed by (candidate, track, chunk)
+stage2_chunks = {}
+if args.resume_job_dir and os.path.exists(stage1_checkpoint):
+    checkpoint = torch.load(stage1_checkpoint, map_location="cpu", weights_only=False)
+    if checkpoint["raw_output"].shape[0] != num_candidates:
+        raise ValueError(f'The checkpoint holds {checkpoint["raw_output"].shape[0]} candidates, but --num_candidates is {num_candidates}.')
+    resume_segment = checkpoint["segment"]
+    random_id = checkpoint["random_id"]
+    raw_output = checkpoint["raw_output"].to(device)
+    raw_attention_mask = checkpoint["raw_attention_mask"].to(device)
+    context_ids = checkpoint["context_ids"].to(device)
+    context_mask = checkpoint["context_mask"].to(device)
+    kv_window.load_state_dict(checkpoint["kv_window"])
+    stage2_chunks = checkpoint.get("stage2_chunks", {})
+    torch.set_rng_state(checkpoint["rng_state"])
+    if checkpoint["cuda_rng_state"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(checkpoint["cuda_rng_state"])
+    if generators is not None:
+        for generator, state in zip(generators, checkpoint["generator_states"]):
+            generator.set_state(state)
+    if "past_key_values" in checkpoint:
+        past_key_values = cache_to_device(checkpoint["past_key_values"], device, into=new_kv_cache())
+        unconditional_past_key_values = cache_to_device(checkpoint["unconditional_past_key_values"], device, into=new_kv_cache(unconditional=True))
+        unconditional_attention_mask = checkpoint["unconditional_attention_mask"].to(device)
+    else:
+        # the unconditional stream starts over, so it holds nothing of the kept segments
+        kv_window.segments = [(conditional_length, 0) for conditional_length, _ in kv_window.segments]
+    print(f"Resuming Stage 1 after segment {resume_segment}.")
+    if args.pipeline_stage2 and resume_segment < run_n_segments - 1:
+        print("--pipeline_stage2 is ignored when resuming Stage 1, Stage 2 runs once Stage 1 has finished.")
+        args.pipeline_stage2 = False
+# Stage 2 can decode the 6s chunks that Stage 1 has completed in a background thread
+stage2_streamer = None
+if args.pipeline_stage2:
+    stage2_queue = queue.Queue()
+    stage2_thread = threading.Thread(target=stage2_worker, args=(model_stage2, stage2_queue, stage2_chunks, args.stage2_batch_size), daemon=True)
+    stage2_thread.start()
+    stage2_streamer = Stage2ChunkStreamer(stage2_queue, num_candidates)
 for i, p in enumerate(tqdm(prompt_texts[:run_n_segments], desc="Stage1 inference...")):
+    # prompt_texts[0] is the instruction, it is part of the first segment's prompt
+    if i <= resume_segment:
+        continue
     section_text = p.replace('[start_of_segment]', '').replace('[end_of_segment]', '')
     guidance_scale = 1.5 if i <=1 else 1.2
-    if i==0:
-        continue
     if i==1:
         if args.use_dual_tracks_prompt or args.use_audio_prompt:
             if args.use_dual_tracks_prompt:
-                vocals_ids = load_audio_mono(args.vocal_track_prompt_path)
-                instrumental_ids = load_audio_mono(args.instrumental_track_prompt_path)
-                vocals_ids = encode_audio(codec_model, vocals_ids, device, target_bw=0.5)
-                instrumental_ids = encode_audio(codec_model, instrumental_ids, device, target_bw=0.5)
+                (vocals_ids, instrumental_ids), first_frame = encode_audio_files(
+                    codec_model,
+                    [args.vocal_track_prompt_path, args.instrumental_track_prompt_path],
+                    device,
+                    target_bw=0.5,
+                    start_time=args.prompt_start_time,
+                    end_time=args.prompt_end_time,
+                )
                 vocals_ids = codectool.npy2ids(vocals_ids[0])
                 instrumental_ids = codectool.npy2ids(instrumental_ids[0])
-                ids_segment_interleaved = rearrange([np.array(vocals_ids), np.array(instrumental_ids)], 'b n -> (n b)')
-                audio_prompt_codec = ids_segment_interleaved[int(args.prompt_start_time*50*2): int(args.prompt_end_time*50*2)]
+                num_frames = min(len(vocals_ids), len(instrumental_ids))
+                ids_segment_interleaved = rearrange([np.array(vocals_ids[:num_frames]), np.array(instrumental_ids[:num_frames])], 'b n -> (n b)')
+                # the codes start at `first_frame` of the tracks
+                audio_prompt_codec = ids_segment_interleaved[int(args.prompt_start_time*50*2) - 2*first_frame: int(args.prompt_end_time*50*2) - 2*first_frame]
                 audio_prompt_codec = audio_prompt_codec.tolist()
             elif args.use_audio_prompt:
-                audio_prompt = load_audio_mono(args.audio_prompt_path)
-                raw_codes = encode_audio(codec_model, audio_prompt, device, target_bw=0.5)
+                (raw_codes,), first_frame = encode_audio_files(
+                    codec_model, [args.audio_prompt_path], device, target_bw=0.5, start_time=args.prompt_start_time, end_time=args.prompt_end_time
+                )
                 # Format audio prompt
                 code_ids = codectool.npy2ids(raw_codes[0])
-                audio_prompt_codec = code_ids[int(args.prompt_start_time *50): int(args.prompt_end_time *50)] # 50 is tps of xcodec
+                audio_prompt_codec = code_ids[int(args.prompt_start_time *50) - first_frame: int(args.prompt_end_time *50) - first_frame] # 50 is tps of xcodec
             audio_prompt_codec_ids = [mmtokenizer.soa] + codectool.sep_ids + audio_prompt_codec + [mmtokenizer.eoa]
             sentence_ids = mmtokenizer.tokenize("[start_of_reference]") +  audio_prompt_codec_ids + mmtokenizer.tokenize("[end_of_reference]")
             head_id = mmtokenizer.tokenize(prompt_texts[0]) + sentence_ids
@@ -284,61 +871,173 @@ for i, p in enumerate(tqdm(prompt_texts[:run_n_segments], desc="Stage1 inference
         prompt_ids = end_of_segment + start_of_segment + mmtokenizer.tokenize(section_text) + [mmtokenizer.soa] + codectool.sep_ids
 
     prompt_ids = torch.as_tensor(prompt_ids).unsqueeze(0).to(device) 
-    input_ids = torch.cat([raw_output, prompt_ids], dim=1) if i > 1 else prompt_ids
-    # Use window slicing in case output sequence exceeds the context of model
-    max_context = 16384-max_new_tokens-1
+    if i > 1:
+        # Evict the oldest segments from the KV caches (never the header nor the last segment) until the new one fits
+        while args.context_policy == "evict_segments" and context_ids.shape[-1] + prompt_ids.shape[-1] > max_context and len(kv_window.segments) > 1:
+            context_ids, context_mask, unconditional_attention_mask = kv_window.evict_oldest(
+                context_ids, context_mask, past_key_values, unconditional_attention_mask, unconditional_past_key_values
+            )
+        context_length = context_ids.shape[-1]
+        input_ids = torch.cat([context_ids, prompt_ids.expand(num_candidates, -1)], dim=1)
+        attention_mask = torch.cat([context_mask, torch.ones_like(prompt_ids).expand(num_candidates, -1)], dim=1)
+    else:
+        kv_window.header_length = context_length = len(head_id)
+        input_ids = prompt_ids
+        attention_mask = torch.ones_like(prompt_ids)
+    # Use window slicing in case output sequence still exceeds the context of model
     if input_ids.shape[-1] > max_context:
         print(f'Section {i}: output length {input_ids.shape[-1]} exceeding context length {max_context}, now using the last {max_context} tokens.')
         input_ids = input_ids[:, -(max_context):]
+        attention_mask = attention_mask[:, -(max_context):]
+        # The cached keys no longer line up with the truncated window, so it has to be prefilled again
+        past_key_values = new_kv_cache()
+        unconditional_past_key_values = None
+        unconditional_attention_mask = None
+        # nothing is pinned anymore, the truncated window becomes part of this segment
+        kv_window.header_length = context_length = 0
+        kv_window.segments = []
+    unconditional_length = unconditional_attention_mask.shape[-1] if unconditional_attention_mask is not None else 0
+    if input_ids.shape[0] < num_candidates or (prefix_cache is not None and i == 1 and context_length > 0):
+        # All candidates start from the same prompt: prefill it once (the header may come from the prefix cache) and
+        # copy the cache to every row
+        past_key_values = prefill_shared_prompt(
+            model, input_ids[:, :-1], num_candidates, into=past_key_values, prefix_length=context_length
+        )
+        input_ids = input_ids.expand(num_candidates, -1)
+        attention_mask = attention_mask.expand(num_candidates, -1)
+    # a restricted LM head already excludes the blocked tokens
+    logits_processor = LogitsProcessorList([] if args.restricted_lm_head else [VocabRangeProcessor(blocked=[(0, 32002)])])
+    if repetition_penalty != 1.0:
+        logits_processor.append(
+            IncrementalRepetitionPenaltyProcessor(
+                repetition_penalty, model.config.vocab_size, args.repetition_penalty_window, model.output_token_ids
+            )
+        )
+    if unconditional_past_key_values is None:
+        unconditional_past_key_values = new_kv_cache(unconditional=True)
+    if compile:
+        # a static cache cannot grow: check that the segment fits before the compiled steps index past its end
+        for name, length, cache in (
+            ("conditional", input_ids.shape[-1], past_key_values),
+            ("unconditional", unconditional_length + 1, unconditional_past_key_values),
+        ):
+            needed = length + max_new_tokens + args.prompt_lookup_num_tokens
+            if needed > cache.get_max_cache_shape():
+                raise ValueError(
+                    f"Section {i}: the {name} CFG stream needs up to {needed} cached tokens, but its static cache holds "
+                    f"{cache.get_max_cache_shape()}. Increase --static_cache_length."
+                )
     with torch.no_grad():
-        output_seq = model.generate(
+        output = model.generate(
             input_ids=input_ids, 
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            unconditional_past_key_values=unconditional_past_key_values,
+            unconditional_attention_mask=unconditional_attention_mask,
+            generators=generators,
+            streamer=stage2_streamer,
+            lookup_num_tokens=args.prompt_lookup_num_tokens if num_candidates == 1 else 0,
+            lookup_ngram_size=args.prompt_lookup_ngram_size,
+            prefill_chunk_size=args.prefill_chunk_size,
+            fused_sampling=args.fused_sampler,
+            return_dict_in_generate=True,
+            return_legacy_cache=False,
             max_new_tokens=max_new_tokens, 
             min_new_tokens=100, 
             do_sample=True, 
             top_p=top_p,
             temperature=temperature, 
-            repetition_penalty=repetition_penalty, 
             eos_token_id=mmtokenizer.eoa,
             pad_token_id=mmtokenizer.eoa,
-            logits_processor=LogitsProcessorList([BlockTokenRangeProcessor(0, 32002), BlockTokenRangeProcessor(32016, 32016)]),
+            logits_processor=logits_processor,
             guidance_scale=guidance_scale,
+            guidance_schedule=guidance_schedule,
             )
-        if output_seq[0][-1].item() != mmtokenizer.eoa:
-            tensor_eoa = torch.as_tensor([[mmtokenizer.eoa]]).to(model.device)
-            output_seq = torch.cat((output_seq, tensor_eoa), dim=1)
+        output_seq = output.sequences
+        past_key_values = output.past_key_values
+        unconditional_past_key_values = output.unconditional_past_key_values
+        unconditional_attention_mask = output.unconditional_attention_mask
+        generated = output_seq[:, input_ids.shape[-1]:]
+        if (generated[:, -1] != mmtokenizer.eoa).any():
+            generated = torch.cat([generated, torch.full_like(generated[:, :1], mmtokenizer.eoa)], dim=1)
+    # Rows that finished early are padded with <EOA>: only the tokens up to their first <EOA> belong to the song
+    is_eoa = (generated == mmtokenizer.eoa).long()
+    generated_mask = ((is_eoa.cumsum(dim=-1) - is_eoa) == 0).long()
     if i > 1:
-        raw_output = torch.cat([raw_output, prompt_ids, output_seq[:, input_ids.shape[-1]:]], dim=1)
+        raw_output = torch.cat([raw_output, prompt_ids.expand(num_candidates, -1), generated], dim=1)
+        raw_attention_mask = torch.cat([raw_attention_mask, torch.ones_like(prompt_ids).expand(num_candidates, -1), generated_mask], dim=1)
     else:
-        raw_output = output_seq
+        raw_output = torch.cat([input_ids, generated], dim=1)
+        raw_attention_mask = torch.cat([attention_mask, generated_mask], dim=1)
+    context_ids = torch.cat([input_ids, generated], dim=1)
+    context_mask = torch.cat([attention_mask, generated_mask], dim=1)
+    kv_window.add_segment(context_ids.shape[-1] - context_length, unconditional_attention_mask.shape[-1] - unconditional_length)
+    checkpoint = {
+        "segment": i,
+        "random_id": random_id,
+        "raw_output": raw_output.cpu(),
+        "raw_attention_mask": raw_attention_mask.cpu(),
+        "context_ids": context_ids.cpu(),
+        "context_mask": context_mask.cpu(),
+        "kv_window": kv_window.state_dict(),
+        "rng_state": torch.get_rng_state(),
+        "cuda_rng_state": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+        "generator_states": [generator.get_state() for generator in generators] if generators is not None else None,
+    }
+    if args.checkpoint_kv_cache:
+        checkpoint["past_key_values"] = cache_to_device(past_key_values, "cpu")
+        checkpoint["unconditional_past_key_values"] = cache_to_device(unconditional_past_key_values, "cpu")
+        checkpoint["unconditional_attention_mask"] = unconditional_attention_mask.cpu()
+    # the worker keeps adding chunks, the copy holds the ones decoded so far
+    checkpoint["stage2_chunks"] = {key: output for key, output in dict(stage2_chunks).items() if key != "error"}
+    save_atomic(stage1_checkpoint, lambda f: torch.save(checkpoint, f))
+
+if args.cfg_schedule != "always":
+    print(f"--cfg_schedule {args.cfg_schedule} skipped the unconditional pass on {guidance_schedule.skipped_fraction:.1%} of {guidance_schedule.total_steps} Stage 1 steps.")
 
 # save raw output and check sanity
-ids = raw_output[0].cpu().numpy()
-soa_idx = np.where(ids == mmtokenizer.soa)[0].tolist()
-eoa_idx = np.where(ids == mmtokenizer.eoa)[0].tolist()
-if len(soa_idx)!=len(eoa_idx):
-    raise ValueError(f'invalid pairs of soa and eoa, Num of soa: {len(soa_idx)}, Num of eoa: {len(eoa_idx)}')
-
-vocals = []
-instrumentals = []
-range_begin = 1 if args.use_audio_prompt or args.use_dual_tracks_prompt else 0
-for i in range(range_begin, len(soa_idx)):
-    codec_ids = ids[soa_idx[i]+1:eoa_idx[i]]
-    if codec_ids[0] == 32016:
-        codec_ids = codec_ids[1:]
-    codec_ids = codec_ids[:2 * (codec_ids.shape[0] // 2)]
-    vocals_ids = codectool.ids2npy(rearrange(codec_ids,"(n b) -> b n", b=2)[0])
-    vocals.append(vocals_ids)
-    instrumentals_ids = codectool.ids2npy(rearrange(codec_ids,"(n b) -> b n", b=2)[1])
-    instrumentals.append(instrumentals_ids)
-vocals = np.concatenate(vocals, axis=1)
-instrumentals = np.concatenate(instrumentals, axis=1)
-vocal_save_path = os.path.join(stage1_output_dir, f"{genres.replace(' ', '-')}_tp{top_p}_T{temperature}_rp{repetition_penalty}_maxtk{max_new_tokens}_{random_id}_vtrack".replace('.', '@')+'.npy')
-inst_save_path = os.path.join(stage1_output_dir, f"{genres.replace(' ', '-')}_tp{top_p}_T{temperature}_rp{repetition_penalty}_maxtk{max_new_tokens}_{random_id}_itrack".replace('.', '@')+'.npy')
-np.save(vocal_save_path, vocals)
-np.save(inst_save_path, instrumentals)
-stage1_output_set.append(vocal_save_path)
-stage1_output_set.append(inst_save_path)
+stage1_track_paths = {}
+for candidate in range(num_candidates):
+    ids = raw_output[candidate][raw_attention_mask[candidate].bool()].cpu().numpy()
+    soa_idx = np.where(ids == mmtokenizer.soa)[0].tolist()
+    eoa_idx = np.where(ids == mmtokenizer.eoa)[0].tolist()
+    if len(soa_idx)!=len(eoa_idx):
+        raise ValueError(f'invalid pairs of soa and eoa, Num of soa: {len(soa_idx)}, Num of eoa: {len(eoa_idx)}')
+
+    vocals = []
+    instrumentals = []
+    range_begin = 1 if args.use_audio_prompt or args.use_dual_tracks_prompt else 0
+    for i in range(range_begin, len(soa_idx)):
+        codec_ids = ids[soa_idx[i]+1:eoa_idx[i]]
+        if codec_ids[0] == 32016:
+            codec_ids = codec_ids[1:]
+        codec_ids = codec_ids[:2 * (codec_ids.shape[0] // 2)]
+        vocals_ids = codectool.ids2npy(rearrange(codec_ids,"(n b) -> b n", b=2)[0])
+        vocals.append(vocals_ids)
+        instrumentals_ids = codectool.ids2npy(rearrange(codec_ids,"(n b) -> b n", b=2)[1])
+        instrumentals.append(instrumentals_ids)
+    vocals = np.concatenate(vocals, axis=1)
+    instrumentals = np.concatenate(instrumentals, axis=1)
+    candidate_id = random_id if num_candidates == 1 else f"{random_id}-c{candidate}"
+    vocal_save_path = os.path.join(stage1_output_dir, f"{genres.replace(' ', '-')}_tp{top_p}_T{temperature}_rp{repetition_penalty}_maxtk{max_new_tokens}_{candidate_id}_vtrack".replace('.', '@')+'.npy')
+    inst_save_path = os.path.join(stage1_output_dir, f"{genres.replace(' ', '-')}_tp{top_p}_T{temperature}_rp{repetition_penalty}_maxtk{max_new_tokens}_{candidate_id}_itrack".replace('.', '@')+'.npy')
+    np.save(vocal_save_path, vocals)
+    np.save(inst_save_path, instrumentals)
+    stage1_output_set.append(vocal_save_path)
+    stage1_output_set.append(inst_save_path)
+    stage1_track_paths[(candidate, "vtrack")] = vocal_save_path
+    stage1_track_paths[(candidate, "itrack")] = inst_save_path
+
+stage2_ready_chunks = {}
+if args.pipeline_stage2:
+    # wait for the chunks already handed over to Stage 2
+    stage2_queue.put(None)
+    stage2_thread.join()
+    if "error" in stage2_chunks:
+        raise stage2_chunks.pop("error")
+# chunks decoded in the background, by this run or (restored from the Stage 1 checkpoint) by a resumed one
+for (row, track, chunk), output in stage2_chunks.items():
+    stage2_ready_chunks.setdefault(stage1_track_paths[(row, track)], {})[chunk] = output
 
 
 # offload model
@@ -347,134 +1046,7 @@ stage1_output_set.append(inst_save_path)
 #     del model
 #     torch.cuda.empty_cache()
 
-def stage2_generate(model, prompt, batch_size=16):
-    codec_ids = codectool.unflatten(prompt, n_quantizer=1)
-    codec_ids = codectool.offset_tok_ids(
-                    codec_ids, 
-                    global_offset=codectool.global_offset, 
-                    codebook_size=codectool.codebook_size, 
-                    num_codebooks=codectool.num_codebooks, 
-                ).astype(np.int32)
-    
-    # Prepare prompt_ids based on batch size or single input
-    if batch_size > 1:
-        codec_list = []
-        for i in range(batch_size):
-            idx_begin = i * 300
-            idx_end = (i + 1) * 300
-            codec_list.append(codec_ids[:, idx_begin:idx_end])
-
-        codec_ids = np.concatenate(codec_list, axis=0)
-        prompt_ids = np.concatenate(
-            [
-                np.tile([mmtokenizer.soa, mmtokenizer.stage_1], (batch_size, 1)),
-                codec_ids,
-                np.tile([mmtokenizer.stage_2], (batch_size, 1)),
-            ],
-            axis=1
-        )
-    else:
-        prompt_ids = np.concatenate([
-            np.array([mmtokenizer.soa, mmtokenizer.stage_1]),
-            codec_ids.flatten(),  # Flatten the 2D array to 1D
-            np.array([mmtokenizer.stage_2])
-        ]).astype(np.int32)
-        prompt_ids = prompt_ids[np.newaxis, ...]
-
-    codec_ids = torch.as_tensor(codec_ids).to(device)
-    prompt_ids = torch.as_tensor(prompt_ids).to(device)
-    len_prompt = prompt_ids.shape[-1]
-    
-    block_list = LogitsProcessorList([BlockTokenRangeProcessor(0, 46358), BlockTokenRangeProcessor(53526, mmtokenizer.vocab_size)])
-
-    # Teacher forcing generate loop
-    for frames_idx in range(codec_ids.shape[1]):
-        cb0 = codec_ids[:, frames_idx:frames_idx+1]
-        prompt_ids = torch.cat([prompt_ids, cb0], dim=1)
-        input_ids = prompt_ids
-
-        with torch.no_grad():
-            stage2_output = model.generate(input_ids=input_ids, 
-                min_new_tokens=7,
-                max_new_tokens=7,
-                eos_token_id=mmtokenizer.eoa,
-                pad_token_id=mmtokenizer.eoa,
-                logits_processor=block_list,
-            )
-        
-        assert stage2_output.shape[1] - prompt_ids.shape[1] == 7, f"output new tokens={stage2_output.shape[1]-prompt_ids.shape[1]}"
-        prompt_ids = stage2_output
-
-    # Return output based on batch size
-    if batch_size > 1:
-        output = prompt_ids.cpu().numpy()[:, len_prompt:]
-        output_list = [output[i] for i in range(batch_size)]
-        output = np.concatenate(output_list, axis=0)
-    else:
-        output = prompt_ids[0].cpu().numpy()[len_prompt:]
-
-    return output
-
-def stage2_inference(model, stage1_output_set, stage2_output_dir, batch_size=4):
-    stage2_result = []
-    for i in tqdm(range(len(stage1_output_set))):
-        output_filename = os.path.join(stage2_output_dir, os.path.basename(stage1_output_set[i]))
-        
-        if os.path.exists(output_filename):
-            print(f'{output_filename} stage2 has done.')
-            continue
-        
-        # Load the prompt
-        prompt = np.load(stage1_output_set[i]).astype(np.int32)
-        
-        # Only accept 6s segments
-        output_duration = prompt.shape[-1] // 50 // 6 * 6
-        num_batch = output_duration // 6
-        
-        if num_batch <= batch_size:
-            # If num_batch is less than or equal to batch_size, we can infer the entire prompt at once
-            output = stage2_generate(model, prompt[:, :output_duration*50], batch_size=num_batch)
-        else:
-            # If num_batch is greater than batch_size, process in chunks of batch_size
-            segments = []
-            num_segments = (num_batch // batch_size) + (1 if num_batch % batch_size != 0 else 0)
-
-            for seg in range(num_segments):
-                start_idx = seg * batch_size * 300
-                # Ensure the end_idx does not exceed the available length
-                end_idx = min((seg + 1) * batch_size * 300, output_duration*50)  # Adjust the last segment
-                current_batch_size = batch_size if seg != num_segments-1 or num_batch % batch_size == 0 else num_batch % batch_size
-                segment = stage2_generate(
-                    model,
-                    prompt[:, start_idx:end_idx],
-                    batch_size=current_batch_size
-                )
-                segments.append(segment)
-
-            # Concatenate all the segments
-            output = np.concatenate(segments, axis=0)
-        
-        # Process the ending part of the prompt
-        if output_duration*50 != prompt.shape[-1]:
-            ending = stage2_generate(model, prompt[:, output_duration*50:], batch_size=1)
-            output = np.concatenate([output, ending], axis=0)
-        output = codectool_stage2.ids2npy(output)
-
-        # Fix invalid codes (a dirty solution, which may harm the quality of audio)
-        # We are trying to find better one
-        fixed_output = copy.deepcopy(output)
-        for i, line in enumerate(output):
-            for j, element in enumerate(line):
-                if element < 0 or element > 1023:
-                    counter = Counter(line)
-                    most_frequant = sorted(counter.items(), key=lambda x: x[1], reverse=True)[0][0]
-                    fixed_output[i, j] = most_frequant
-        # save output
-        np.save(output_filename, fixed_output)
-        stage2_result.append(output_filename)
-    return stage2_result
-
-stage2_result = stage2_inference(model_stage2, stage1_output_set, stage2_output_dir, batch_size=args.stage2_batch_size)
+stage2_result = stage2_inference(model_stage2, stage1_output_set, stage2_output_dir, batch_size=args.stage2_batch_size, ready_chunks=stage2_ready_chunks)
 print(stage2_result)
 print('Stage 2 DONE.\n')
 # convert audio tokens to audio
@@ -527,41 +1099,45 @@ vocoder_stems_dir = os.path.join(vocoder_output_dir, 'stems')
 vocoder_mix_dir = os.path.join(vocoder_output_dir, 'mix')
 os.makedirs(vocoder_mix_dir, exist_ok=True)
 os.makedirs(vocoder_stems_dir, exist_ok=True)
-for npy in stage2_result:
-    if '_itrack' in npy:
-        # Process instrumental
-        instrumental_output = process_audio(
-            npy,
-            os.path.join(vocoder_stems_dir, 'itrack.mp3'),
-            args.rescale,
-            args,
-            inst_decoder,
-            codec_model
-        )
-    else:
-        # Process vocal
-        vocal_output = process_audio(
-            npy,
-            os.path.join(vocoder_stems_dir, 'vtrack.mp3'),
-            args.rescale,
-            args,
-            vocal_decoder,
-            codec_model
-        )
-# mix tracks
-try:
-    mix_output = instrumental_output + vocal_output
+for candidate, npy in enumerate(npy for npy in stage2_result if '_itrack' in npy):
+    # Each candidate is upsampled and mixed as its own instrumental/vocal pair, the stems of a single candidate keep
+    # the plain itrack.mp3 / vtrack.mp3 names
+    vocal_npy = npy.replace('_itrack', '_vtrack')
+    stem_suffix = "" if num_candidates == 1 else f"-c{candidate}"
+    recons_mix = os.path.join(recons_mix_dir, os.path.splitext(os.path.basename(npy))[0].replace('_itrack', '_mixed') + '.mp3')
+    # Process instrumental
+    instrumental_output = process_audio(
+        npy,
+        os.path.join(vocoder_stems_dir, f'itrack{stem_suffix}.mp3'),
+        args.rescale,
+        args,
+        inst_decoder,
+        codec_model
+    )
+    # Process vocal
+    vocal_output = process_audio(
+        vocal_npy,
+        os.path.join(vocoder_stems_dir, f'vtrack{stem_suffix}.mp3'),
+        args.rescale,
+        args,
+        vocal_decoder,
+        codec_model
+    )
+    # mix tracks
     vocoder_mix = os.path.join(vocoder_mix_dir, os.path.basename(recons_mix))
-    save_audio(mix_output, vocoder_mix, 44100, args.rescale)
-    print(f"Created mix: {vocoder_mix}")
-except RuntimeError as e:
-    print(e)
-    print(f"mix {vocoder_mix} failed! inst: {instrumental_output.shape}, vocal: {vocal_output.shape}")
-
-# Post process
-replace_low_freq_with_energy_matched(
-    a_file=recons_mix,     # 16kHz
-    b_file=vocoder_mix,     # 48kHz
-    c_file=os.path.join(args.output_dir, os.path.basename(recons_mix)),
-    cutoff_freq=5500.0
-)
+    try:
+        mix_output = instrumental_output + vocal_output
+        save_audio(mix_output, vocoder_mix, 44100, args.rescale)
+        print(f"Created mix: {vocoder_mix}")
+    except RuntimeError as e:
+        print(e)
+        print(f"mix {vocoder_mix} failed! inst: {instrumental_output.shape}, vocal: {vocal_output.shape}")
+        continue
+
+    # Post process
+    replace_low_freq_with_energy_matched(
+        a_file=recons_mix,     # 16kHz
+        b_file=vocoder_mix,     # 48kHz
+        c_file=os.path.join(args.output_dir, os.path.basename(recons_mix)),
+        cutoff_freq=5500.0
+    )
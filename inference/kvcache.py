@@ -0,0 +1,261 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import torch
+from transformers import DynamicCache, StaticCache
+from transformers.models.llama.modeling_llama import rotate_half
+
+
+class PreallocatedCache(DynamicCache):
+    """DynamicCache that keeps every layer in a buffer with spare capacity and writes new tokens in place.
+
+    `key_cache[layer_idx]` / `value_cache[layer_idx]` are views of the valid prefix of the buffers, the capacity grows
+    by at least `block_size` tokens (and at least by half) when it runs out. DynamicCache operations that replace
+    those tensors (`batch_repeat_interleave`, `batch_select_indices`, ...) keep working: a layer whose tensor is no
+    longer a prefix view of its buffer is copied into a buffer of its own size on its next update. `crop` keeps the
+    views, so the cropped tokens are simply overwritten, and `evict_cache_range` compacts the layers inside their
+    buffers.
+    """
+    def __init__(self, block_size=1024):
+        super().__init__()
+        self.block_size = block_size
+        self._key_buffers = []
+        self._value_buffers = []
+
+    @staticmethod
+    def _is_prefix_view(tensor, buffer):
+        return (
+            buffer is not None
+            and tensor.data_ptr() == buffer.data_ptr()
+            and tensor.shape[:2] == buffer.shape[:2]
+            and tensor.stride() == buffer.stride()
+        )
+
+    def _reserve(self, layer_idx, length):
+        """Makes sure the buffers of `layer_idx` hold its current tokens and have room for `length` tokens."""
+        keys, values = self.key_cache[layer_idx], self.value_cache[layer_idx]
+        key_buffer, value_buffer = self._key_buffers[layer_idx], self._value_buffers[layer_idx]
+        if self._is_prefix_view(keys, key_buffer):
+            if key_buffer.shape[-2] >= length:
+                return key_buffer, value_buffer
+            # a full buffer grows geometrically
+            capacity = max(length, key_buffer.shape[-2] + key_buffer.shape[-2] // 2)
+        else:
+            # a replaced layer (e.g. after `batch_repeat_interleave`) is adopted at its own size, a larger old buffer
+            # is not a reason to grow
+            capacity = length
+        capacity = -(-capacity // self.block_size) * self.block_size
+        key_buffer = keys.new_empty((*keys.shape[:-2], capacity, keys.shape[-1]))
+        value_buffer = values.new_empty((*values.shape[:-2], capacity, values.shape[-1]))
+        key_buffer[:, :, : keys.shape[-2]] = keys
+        value_buffer[:, :, : values.shape[-2]] = values
+        self._key_buffers[layer_idx], self._value_buffers[layer_idx] = key_buffer, value_buffer
+        return key_buffer, value_buffer
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        if layer_idx == 0:
+            self._seen_tokens += key_states.shape[-2]
+        # skipped layers are filled with empty lists, as in DynamicCache
+        while len(self.key_cache) <= layer_idx:
+            self.key_cache.append([])
+            self.value_cache.append([])
+        while len(self._key_buffers) <= layer_idx:
+            self._key_buffers.append(None)
+            self._value_buffers.append(None)
+        if len(self.key_cache[layer_idx]) == 0:
+            self.key_cache[layer_idx] = key_states[:, :, :0]
+            self.value_cache[layer_idx] = value_states[:, :, :0]
+            self._key_buffers[layer_idx] = self._value_buffers[layer_idx] = None
+        length = self.key_cache[layer_idx].shape[-2]
+        new_length = length + key_states.shape[-2]
+        key_buffer, value_buffer = self._reserve(layer_idx, new_length)
+        key_buffer[:, :, length:new_length] = key_states
+        value_buffer[:, :, length:new_length] = value_states
+        self.key_cache[layer_idx] = key_buffer[:, :, :new_length]
+        self.value_cache[layer_idx] = value_buffer[:, :, :new_length]
+        return self.key_cache[layer_idx], self.value_cache[layer_idx]
+
+
+def quantize_int8(states):
+    """Quantizes (..., head_dim) states with one scale per token and head.
+
+    The fp16 scale is stored as two extra int8 "channels" after the head dim, so that slicing, concatenating and
+    indexing the packed tensor along the batch or sequence dimensions keeps data and scales together.
+    """
+    scale = states.abs().amax(dim=-1, keepdim=True).float().clamp(min=1e-6) / 127
+    quantized = torch.round(states.float() / scale).clamp(-127, 127).to(torch.int8)
+    return torch.cat([quantized, scale.to(torch.float16).view(torch.int8)], dim=-1)
+
+
+def dequantize_int8(packed, dtype):
+    """Inverse of `quantize_int8`."""
+    scale = packed[..., -2:].contiguous().view(torch.float16)
+    return packed[..., :-2].to(dtype) * scale.to(dtype)
+
+
+class QuantizedKVCache(PreallocatedCache):
+    """PreallocatedCache that stores keys and values as int8 with a per token and head scale (see `quantize_int8`).
+
+    New states are quantized when they are written, `update` returns the dequantized keys and values of the layer to
+    the attention. This halves the memory of a bf16 cache at the cost of dequantizing every layer on every step.
+    States that are already packed int8 (e.g. from `to_legacy_cache` of another QuantizedKVCache) are stored as is.
+    """
+    def __init__(self, block_size=1024, dtype=torch.bfloat16):
+        super().__init__(block_size)
+        # dtype of the dequantized states, follows the states written into the cache
+        self.dtype = dtype
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        if key_states.dtype != torch.int8:
+            self.dtype = key_states.dtype
+            key_states, value_states = quantize_int8(key_states), quantize_int8(value_states)
+        keys, values = super().update(key_states, value_states, layer_idx, cache_kwargs)
+        return dequantize_int8(keys, self.dtype), dequantize_int8(values, self.dtype)
+
+
+def evict_cache_range(cache, start, end, attention_mask, inv_freq):
+    """Removes the entries [start, end) of every layer of a DynamicCache (or StaticCache) in place.
+
+    The keys that follow the evicted range are rotated back by the number of evicted tokens of their row (the ones
+    of `attention_mask[:, start:end]`), so that their RoPE positions stay those derived from the remaining attention
+    mask. Returns `attention_mask` without the evicted columns. `cache` may be None, then only the mask is updated.
+    """
+    if cache is not None and cache.get_seq_length() > start:
+        shift = attention_mask[:, start:end].sum(dim=-1).float()
+        freqs = -shift[:, None] * inv_freq[None, :].float().to(shift.device)
+        emb = torch.cat([freqs, freqs], dim=-1)[:, None, None, :]
+        cos, sin = emb.cos(), emb.sin()
+        for layer_idx in range(len(cache.key_cache)):
+            keys = cache.key_cache[layer_idx]
+            values = cache.value_cache[layer_idx]
+            # int8 caches store packed keys (see `quantize_int8`), they are rotated in float and quantized again
+            quantized = keys.dtype == torch.int8
+            kept_keys = dequantize_int8(keys[:, :, end:], torch.float32) if quantized else keys[:, :, end:].float()
+            layer_cos, layer_sin = cos.to(keys.device), sin.to(keys.device)
+            kept_keys = kept_keys * layer_cos + rotate_half(kept_keys) * layer_sin
+            kept_keys = quantize_int8(kept_keys) if quantized else kept_keys.to(keys.dtype)
+            if isinstance(cache, StaticCache):
+                # the buffers of a static cache keep their size and address (compiled steps use them), the entries
+                # are moved in place and the freed slots at the end are zeroed
+                kept_length = start + kept_keys.shape[2]
+                keys[:, :, start:kept_length] = kept_keys
+                values[:, :, start:kept_length] = values[:, :, end:].clone()
+                keys[:, :, kept_length:].zero_()
+                values[:, :, kept_length:].zero_()
+                continue
+            if isinstance(cache, PreallocatedCache) and cache._is_prefix_view(keys, cache._key_buffers[layer_idx]):
+                # compacted inside the buffers, which keep their capacity for the next tokens
+                kept_length = start + kept_keys.shape[2]
+                keys[:, :, start:kept_length] = kept_keys
+                values[:, :, start:kept_length] = values[:, :, end:].clone()
+                cache.key_cache[layer_idx] = keys[:, :, :kept_length]
+                cache.value_cache[layer_idx] = values[:, :, :kept_length]
+                continue
+            cache.key_cache[layer_idx] = torch.cat([keys[:, :, :start], kept_keys], dim=2)
+            cache.value_cache[layer_idx] = torch.cat([values[:, :, :start], values[:, :, end:]], dim=2)
+        if hasattr(cache, "_seen_tokens"):
+            cache._seen_tokens -= end - start
+    return torch.cat([attention_mask[:, :start], attention_mask[:, end:]], dim=-1)
+
+
+class SegmentKVWindow:
+    """Sliding window over the Stage 1 KV caches at lyric segment granularity.
+
+    The header (instruction and audio reference) is pinned. Whole segments, i.e. their prompt and generated tokens,
+    are evicted oldest first from both the conditional and the unconditional (CFG) cache.
+    """
+    def __init__(self, inv_freq, header_length=0):
+        self.inv_freq = inv_freq
+        self.header_length = header_length
+        # (conditional length, unconditional length) of every kept segment, oldest first
+        self.segments = []
+
+    def add_segment(self, conditional_length, unconditional_length):
+        self.segments.append((conditional_length, unconditional_length))
+
+    def evict_oldest(self, context_ids, attention_mask, past_key_values, unconditional_attention_mask, unconditional_past_key_values):
+        """Evicts the oldest segment. Returns the remaining context ids, attention mask and unconditional attention mask."""
+        conditional_length, unconditional_length = self.segments.pop(0)
+        start, end = self.header_length, self.header_length + conditional_length
+        context_ids = torch.cat([context_ids[:, :start], context_ids[:, end:]], dim=-1)
+        attention_mask = evict_cache_range(past_key_values, start, end, attention_mask, self.inv_freq)
+        if unconditional_attention_mask is not None:
+            unconditional_attention_mask = evict_cache_range(
+                unconditional_past_key_values, 0, unconditional_length, unconditional_attention_mask, self.inv_freq
+            )
+        return context_ids, attention_mask, unconditional_attention_mask
+
+    def state_dict(self):
+        return {"header_length": self.header_length, "segments": list(self.segments)}
+
+    def load_state_dict(self, state):
+        self.header_length = state["header_length"]
+        self.segments = list(state["segments"])
+
+
+class PrefixKVCache:
+    """Prefilled KV states of prompt prefixes (e.g. the Stage 1 instruction and audio reference) shared across jobs.
+
+    Entries are keyed by a hash of `model_id` (which has to identify the weights and the cache format) and the token
+    ids. The memory tier keeps the most recently used entries on the CPU, up to `max_memory_bytes`. If `cache_dir` is
+    set, entries are also written there and loaded memory-mapped, so that later processes find them.
+    """
+    def __init__(self, model_id, cache_dir=None, max_memory_bytes=2 * 2**30):
+        self.model_id = model_id
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self._entries = OrderedDict()
+        self._memory_bytes = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, token_ids):
+        digest = hashlib.sha256(self.model_id.encode())
+        digest.update(token_ids.to(torch.int64).cpu().numpy().tobytes())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pt")
+
+    def _remember(self, key, entry):
+        entry_bytes = sum(tensor.nbytes for tensor in entry["keys"] + entry["values"])
+        if entry_bytes > self.max_memory_bytes:
+            return
+        self._entries[key] = entry
+        self._memory_bytes += entry_bytes
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._memory_bytes -= sum(tensor.nbytes for tensor in evicted["keys"] + evicted["values"])
+
+    def load(self, token_ids, into):
+        """Writes the cached states of `token_ids` (1, seq_len) into the empty cache `into`. Returns whether they were found."""
+        key = self.key(token_ids)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        elif self.cache_dir and os.path.exists(self._path(key)):
+            entry = torch.load(self._path(key), map_location="cpu", mmap=True, weights_only=True)
+            self._remember(key, entry)
+        if entry is None:
+            return False
+        device = token_ids.device
+        cache_position = torch.arange(token_ids.shape[-1], device=device)
+        for layer_idx, (keys, values) in enumerate(zip(entry["keys"], entry["values"])):
+            into.update(keys.to(device), values.to(device), layer_idx, {"cache_position": cache_position})
+        return True
+
+    def store(self, token_ids, cache):
+        """Stores the states of the first `token_ids.shape[-1]` tokens of the single row `cache`."""
+        key = self.key(token_ids)
+        length = token_ids.shape[-1]
+        entry = {
+            "keys": [keys[:, :, :length].cpu().clone() for keys in cache.key_cache],
+            "values": [values[:, :, :length].cpu().clone() for values in cache.value_cache],
+        }
+        self._remember(key, entry)
+        if self.cache_dir and not os.path.exists(self._path(key)):
+            # written through a temporary file, so that concurrent jobs never load a partial entry
+            tmp_path = f"{self._path(key)}.{os.getpid()}.tmp"
+            torch.save(entry, tmp_path)
+            os.replace(tmp_path, self._path(key))
@@ -0,0 +1,335 @@
+"""Standalone decoding engine for the YuE Stage 1 and Stage 2 Llama checkpoints.
+
+`YuEEngine` wraps a `transformers` LlamaForCausalLM (stock or patched, the weights are loaded as usual) and runs its
+layers with its own prefill / decode loop: both classifier-free guidance streams share one pass through the layer
+weights, the KV caches are regular `transformers` Cache objects (so the caches of kvcache.py can be used), and
+sampling works directly on the scores of the LM head. `generate` and `__call__` accept the arguments infer.py passes to
+the HF model, so it does not depend on the patched `generation/utils.py` and `modeling_llama.py`.
+"""
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+from transformers import DynamicCache, LogitsProcessorList
+from transformers.models.llama.modeling_llama import apply_rotary_pos_emb, repeat_kv
+
+
+# `generate` arguments the engine does not implement, with the value that leaves the decode unchanged (None: any value
+# does). Any other value of these, and any other argument, is rejected.
+NEUTRAL_GENERATE_KWARGS = {
+    "lookup_num_tokens": 0,
+    "lookup_ngram_size": None,
+    "fused_sampling": False,
+    "repetition_penalty": 1.0,
+    "num_beams": 1,
+    "num_return_sequences": 1,
+    "output_scores": False,
+    "output_logits": False,
+    "output_attentions": False,
+    "output_hidden_states": False,
+    "return_dict_in_generate": True,
+    "return_legacy_cache": None,
+    "use_cache": True,
+}
+
+
+class EngineOutput:
+    """The fields of the HF model and `generate` outputs that infer.py reads."""
+    def __init__(self, sequences=None, logits=None, past_key_values=None, unconditional_past_key_values=None, unconditional_attention_mask=None):
+        self.sequences = sequences
+        self.logits = logits
+        self.past_key_values = past_key_values
+        self.unconditional_past_key_values = unconditional_past_key_values
+        self.unconditional_attention_mask = unconditional_attention_mask
+
+
+def attention_mask_4d(key_mask, query_length):
+    """Boolean (batch, 1, query_length, key_length) SDPA mask for the last `query_length` positions of `key_mask`.
+
+    Queries attend causally to the unmasked keys. A query always attends to itself, so that padding queries do not
+    produce NaNs (their outputs are never used).
+    """
+    key_length = key_mask.shape[-1]
+    key_positions = torch.arange(key_length, device=key_mask.device)
+    query_positions = key_positions[key_length - query_length :, None]
+    causal = key_positions[None, :] <= query_positions
+    return (key_mask.bool()[:, None, None, :] & causal) | (key_positions[None, :] == query_positions)
+
+
+def position_ids_from_mask(key_mask, query_length):
+    """RoPE positions of the last `query_length` positions of `key_mask`, padding is skipped (as in `generate`)."""
+    position_ids = key_mask.long().cumsum(-1) - 1
+    position_ids.masked_fill_(key_mask == 0, 1)
+    return position_ids[:, -query_length:]
+
+
+def warp_scores(scores, temperature=1.0, top_k=None, top_p=1.0):
+    """Applies temperature, top-k and top-p to `scores` as `TemperatureLogitsWarper`, `TopKLogitsWarper` and
+    `TopPLogitsWarper` do (filtered tokens get -inf). The nucleus is searched among the top-k candidates only."""
+    if temperature != 1.0:
+        scores = scores / temperature
+    if not top_k and top_p >= 1.0:
+        return scores
+    if top_k:
+        candidate_scores, candidate_indices = torch.topk(scores, min(top_k, scores.shape[-1]), dim=-1)
+    else:
+        candidate_scores, candidate_indices = torch.sort(scores, dim=-1, descending=True)
+    if top_p < 1.0:
+        probs = candidate_scores.softmax(dim=-1)
+        # same tokens as `TopPLogitsWarper`: those whose more likely tokens hold less than `top_p` of the mass
+        candidate_scores = candidate_scores.masked_fill(probs.cumsum(dim=-1) - probs >= top_p, -float("inf"))
+    return torch.full_like(scores, -float("inf")).scatter_(-1, candidate_indices, candidate_scores)
+
+
+def sample_tokens(scores, generators=None):
+    """Draws one index per row from softmax(scores) with the Gumbel-max trick, `argmax(p / E)` with `E ~ Exp(1)`, using
+    the generator of each row if `generators` is given."""
+    probs = scores.softmax(dim=-1)
+    noise = torch.empty_like(probs)
+    if generators is not None:
+        for row, generator in enumerate(generators):
+            noise[row].exponential_(generator=generator)
+    else:
+        noise.exponential_()
+    return (probs / noise.clamp_(min=torch.finfo(noise.dtype).tiny)).argmax(dim=-1)
+
+
+class YuEEngine(nn.Module):
+    """Prefill, decode, classifier-free guidance and sampling for a LlamaForCausalLM.
+
+    `model` is the LlamaModel of the wrapped checkpoint (embeddings, layers, norm, rotary embedding), so that code that
+    reads e.g. `model.model.rotary_emb` works with either. With `set_output_token_ids` the LM head only scores the given
+    token ids, logits processors then receive these compact scores.
+    """
+    def __init__(self, model, output_token_ids=None):
+        super().__init__()
+        self.model = model.model
+        self.lm_head = model.lm_head
+        self.config = model.config
+        self.generation_config = model.generation_config
+        self.set_output_token_ids(output_token_ids)
+
+    @property
+    def dtype(self):
+        return self.lm_head.weight.dtype
+
+    def set_output_token_ids(self, output_token_ids=None):
+        """Restricts the LM head to `output_token_ids` (as `set_output_token_ids` of the patched model), None restores the full vocabulary."""
+        if output_token_ids is not None:
+            output_token_ids = torch.as_tensor(output_token_ids, dtype=torch.long, device=self.lm_head.weight.device)
+        self.output_token_ids = output_token_ids
+        self._output_weight = None
+        self._output_weight_key = None
+
+    def _output_logits(self, hidden_states):
+        if self.output_token_ids is None:
+            return self.lm_head(hidden_states)
+        weight = self.lm_head.weight
+        # rebuilt when the LM head is moved (e.g. offloaded between the stages)
+        key = (weight.data_ptr(), weight.device, hidden_states.device)
+        if self._output_weight_key != key:
+            self._output_weight = weight[self.output_token_ids.to(weight.device)].to(hidden_states.device)
+            self.output_token_ids = self.output_token_ids.to(hidden_states.device)
+            self._output_weight_key = key
+        return F.linear(hidden_states, self._output_weight)
+
+    def _forward(self, streams, num_logits_to_keep=1):
+        """Runs `streams`, a list of (input_ids, key_mask, cache), through the model in one pass.
+
+        `key_mask` covers the cached tokens followed by `input_ids`. The projections and MLPs run on the streams
+        concatenated along the sequence, the attention per stream. Returns the logits of the last
+        `num_logits_to_keep` positions (0 for all) of every stream.
+        """
+        lengths = [input_ids.shape[1] for input_ids, _, _ in streams]
+        hidden_states = self.model.embed_tokens(torch.cat([input_ids for input_ids, _, _ in streams], dim=1))
+        stream_inputs = []
+        for (input_ids, key_mask, cache), length in zip(streams, lengths):
+            cos, sin = self.model.rotary_emb(hidden_states, position_ids_from_mask(key_mask, length))
+            past_length = key_mask.shape[-1] - length
+            cache_position = torch.arange(past_length, past_length + length, device=input_ids.device)
+            stream_inputs.append((cos, sin, attention_mask_4d(key_mask, length), cache, cache_position))
+
+        batch_size, total_length, _ = hidden_states.shape
+        for layer_idx, layer in enumerate(self.model.layers[: self.config.num_hidden_layers]):
+            attention = layer.self_attn
+            residual = hidden_states
+            hidden_states = layer.input_layernorm(hidden_states)
+            hidden_shape = (batch_size, total_length, -1, attention.head_dim)
+            query_states = attention.q_proj(hidden_states).view(hidden_shape).transpose(1, 2)
+            key_states = attention.k_proj(hidden_states).view(hidden_shape).transpose(1, 2)
+            value_states = attention.v_proj(hidden_states).view(hidden_shape).transpose(1, 2)
+
+            attn_outputs = []
+            start = 0
+            for (cos, sin, mask, cache, cache_position), length in zip(stream_inputs, lengths):
+                tokens = slice(start, start + length)
+                stream_query, stream_key = apply_rotary_pos_emb(query_states[:, :, tokens], key_states[:, :, tokens], cos, sin)
+                stream_key, stream_value = cache.update(
+                    stream_key, value_states[:, :, tokens], layer_idx, {"sin": sin, "cos": cos, "cache_position": cache_position}
+                )
+                stream_key = repeat_kv(stream_key, attention.num_key_value_groups)
+                stream_value = repeat_kv(stream_value, attention.num_key_value_groups)
+                attn_outputs.append(
+                    F.scaled_dot_product_attention(stream_query, stream_key, stream_value, attn_mask=mask, scale=attention.scaling)
+                )
+                start += length
+            attn_output = torch.cat(attn_outputs, dim=2).transpose(1, 2).reshape(batch_size, total_length, -1)
+            hidden_states = residual + attention.o_proj(attn_output)
+            hidden_states = hidden_states + layer.mlp(layer.post_attention_layernorm(hidden_states))
+
+        logits = []
+        start = 0
+        for length in lengths:
+            keep = length if num_logits_to_keep == 0 else min(num_logits_to_keep, length)
+            logits.append(self._output_logits(self.model.norm(hidden_states[:, start + length - keep : start + length])))
+            start += length
+        return logits
+
+    def forward(self, input_ids, past_key_values=None, attention_mask=None, num_logits_to_keep=0, **kwargs):
+        """Single stream forward with the HF call signature used by infer.py (`cache_position` and `use_cache` are implied)."""
+        past_key_values = DynamicCache() if past_key_values is None else past_key_values
+        if attention_mask is None:
+            past_length = past_key_values.get_seq_length()
+            attention_mask = input_ids.new_ones((input_ids.shape[0], past_length + input_ids.shape[1]))
+        logits = self._forward([(input_ids, attention_mask, past_key_values)], num_logits_to_keep)[0]
+        return EngineOutput(logits=logits, past_key_values=past_key_values)
+
+    @torch.no_grad()
+    def generate(
+        self,
+        input_ids,
+        attention_mask=None,
+        past_key_values=None,
+        unconditional_past_key_values=None,
+        unconditional_attention_mask=None,
+        max_new_tokens=100,
+        min_new_tokens=0,
+        do_sample=False,
+        temperature=1.0,
+        top_k=None,
+        top_p=1.0,
+        guidance_scale=None,
+        logits_processor=None,
+        eos_token_id=None,
+        pad_token_id=None,
+        generators=None,
+        streamer=None,
+        prefill_chunk_size=0,
+        guidance_schedule=None,
+        **kwargs,
+    ):
+        """Samples up to `max_new_tokens` tokens after `input_ids`, like the patched `generate` does.
+
+        `past_key_values` holds the tokens of `input_ids` that are already cached. If `guidance_scale` is set, the
+        unconditional stream is continued from `unconditional_past_key_values` with the last input token, and the
+        scores are `guidance_scale * (cond - uncond) + uncond` of the log-softmaxed logits. A `guidance_schedule` (see
+        guidance.py) decides on which steps the unconditional stream runs. `top_k` defaults to the
+        model's generation config, as in `generate`. Other `generate` arguments (e.g. prompt lookup, fused sampling)
+        raise a ValueError unless they leave the decode unchanged, see `NEUTRAL_GENERATE_KWARGS`.
+        """
+        for name, value in kwargs.items():
+            if name not in NEUTRAL_GENERATE_KWARGS:
+                raise ValueError(f"YuEEngine.generate does not support the `{name}` argument.")
+            neutral = NEUTRAL_GENERATE_KWARGS[name]
+            if neutral is not None and value != neutral:
+                raise ValueError(f"YuEEngine.generate does not support `{name}={value!r}` (only {neutral!r}), use the 'hf' engine.")
+        if top_k is None:
+            top_k = self.generation_config.top_k
+        batch_size, prompt_length = input_ids.shape
+        device = input_ids.device
+        past_key_values = DynamicCache() if past_key_values is None else past_key_values
+        if attention_mask is None:
+            attention_mask = input_ids.new_ones(input_ids.shape)
+        use_guidance = guidance_scale is not None and guidance_scale > 0
+        if use_guidance:
+            if unconditional_past_key_values is None:
+                unconditional_past_key_values = DynamicCache()
+            if unconditional_attention_mask is None:
+                unconditional_attention_mask = attention_mask.new_ones((batch_size, unconditional_past_key_values.get_seq_length()))
+        else:
+            guidance_schedule = None
+        if guidance_schedule is not None:
+            guidance_schedule.start()
+        # mask columns of the tokens the unconditional stream has not been fed yet (steps skipped by the schedule)
+        unconditional_pending_mask = None
+        logits_processor = LogitsProcessorList() if logits_processor is None else logits_processor
+        eos_column = None
+        if eos_token_id is not None:
+            eos_column = eos_token_id
+            if self.output_token_ids is not None:
+                matches = (self.output_token_ids == eos_token_id).nonzero()
+                eos_column = matches[0, 0].item() if matches.shape[0] > 0 else None
+
+        output_ids = input_ids.new_full((batch_size, prompt_length + max_new_tokens), 0 if pad_token_id is None else pad_token_id)
+        output_ids[:, :prompt_length] = input_ids
+        cur_len = prompt_length
+        # the prompt tokens that are not cached yet, all but the last block are prefilled into the conditional stream
+        past_length = past_key_values.get_seq_length()
+        step_ids = input_ids[:, past_length:]
+        while prefill_chunk_size > 0 and step_ids.shape[1] > prefill_chunk_size:
+            past_length += prefill_chunk_size
+            self._forward([(step_ids[:, :prefill_chunk_size], attention_mask[:, :past_length], past_key_values)])
+            step_ids = step_ids[:, prefill_chunk_size:]
+
+        if streamer is not None:
+            # as in `generate`, the first call of the streamer carries the prompt
+            streamer.put(input_ids.cpu())
+        unfinished = torch.ones(batch_size, dtype=torch.bool, device=device)
+        for step in range(max_new_tokens):
+            streams = [(step_ids, attention_mask, past_key_values)]
+            run_unconditional = use_guidance and (guidance_schedule is None or guidance_schedule.step())
+            if use_guidance:
+                # tokens of finished rows are padding of the unconditional stream
+                new_mask = unfinished[:, None].to(unconditional_attention_mask.dtype)
+                if unconditional_pending_mask is not None:
+                    new_mask = torch.cat([unconditional_pending_mask, new_mask], dim=-1)
+                unconditional_pending_mask = None if run_unconditional else new_mask
+            if run_unconditional:
+                unconditional_attention_mask = torch.cat([unconditional_attention_mask, new_mask], dim=-1)
+                unconditional_ids = output_ids[:, cur_len - new_mask.shape[1] : cur_len]
+                streams.append((unconditional_ids, unconditional_attention_mask, unconditional_past_key_values))
+            logits = self._forward(streams)
+            scores = logits[0][:, -1].float()
+            if use_guidance:
+                conditional_scores = F.log_softmax(scores, dim=-1)
+                unconditional_scores = F.log_softmax(logits[1][:, -1].float(), dim=-1) if run_unconditional else None
+                if guidance_schedule is not None:
+                    unconditional_scores = guidance_schedule.guide(conditional_scores, unconditional_scores, unfinished)
+                if unconditional_scores is None:
+                    scores = conditional_scores
+                else:
+                    scores = guidance_scale * (conditional_scores - unconditional_scores) + unconditional_scores
+            if step < min_new_tokens and eos_column is not None:
+                scores[:, eos_column] = -float("inf")
+            # `generate` applies the custom processors first and the sampling warpers after them
+            scores = logits_processor(output_ids[:, :cur_len], scores)
+            if do_sample:
+                scores = warp_scores(scores, temperature, top_k, top_p)
+
+            if do_sample:
+                next_tokens = sample_tokens(scores, generators)
+            else:
+                next_tokens = scores.argmax(dim=-1)
+            if self.output_token_ids is not None:
+                next_tokens = self.output_token_ids[next_tokens]
+            if pad_token_id is not None:
+                next_tokens = torch.where(unfinished, next_tokens, pad_token_id)
+            output_ids[:, cur_len] = next_tokens
+            cur_len += 1
+            if streamer is not None:
+                streamer.put(next_tokens.cpu())
+            if eos_token_id is not None:
+                unfinished &= next_tokens != eos_token_id
+            attention_mask = torch.cat([attention_mask, attention_mask.new_ones((batch_size, 1))], dim=-1)
+            step_ids = next_tokens[:, None]
+            if not unfinished.any():
+                break
+        if streamer is not None:
+            streamer.end()
+
+        return EngineOutput(
+            sequences=output_ids[:, :cur_len].clone(),
+            past_key_values=past_key_values,
+            unconditional_past_key_values=unconditional_past_key_values,
+            unconditional_attention_mask=unconditional_attention_mask,
+        )
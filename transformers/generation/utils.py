@@ -2005,6 +2005,19 @@ class GenerationMixin:
 
         if "guidance_scale" in kwargs:
             self._guidance_scale = kwargs.get("guidance_scale",1)
+        # optional list of `torch.Generator`, one per batch row, used by multinomial sampling
+        self._sampling_generators = kwargs.pop("generators", None)
+        # prompt lookup speculative decoding in `_sample`: number of drafted tokens per step (0 disables it) and
+        # longest n-gram matched against the context
+        self._lookup_num_tokens = kwargs.pop("lookup_num_tokens", 0)
+        self._lookup_ngram_size = kwargs.pop("lookup_ngram_size", 3)
+        # chunked prefill in `_sample`: the prompt is fed in blocks of this many tokens (0 feeds it at once)
+        self._prefill_chunk_size = kwargs.pop("prefill_chunk_size", 0)
+        # sample with `_fused_sample` in `_sample` instead of the temperature / top-k / top-p warpers and multinomial
+        self._fused_sampling = kwargs.pop("fused_sampling", False)
+        # adaptive classifier-free guidance: an object with `start()`, `step()` and `guide()` (see `GuidanceSchedule`
+        # of YuE's inference/guidance.py) that decides on which steps of `_sample` the unconditional stream is run
+        self._guidance_schedule = kwargs.pop("guidance_schedule", None)
         # 1. Handle `generation_config` and kwargs that might update it, and validate the `.generate()` call
         self._validate_model_class()
         tokenizer = kwargs.pop("tokenizer", None)  # Pull this out first, we only use it for stopping criteria
@@ -3161,6 +3174,84 @@ class GenerationMixin:
         else:
             return input_ids
 
+    def _get_restricted_vocab_processor(
+        self, logits_processor: LogitsProcessorList, output_token_ids: torch.LongTensor
+    ) -> Callable:
+        r"""
+        Adapts `logits_processor` to the compact scores of a restricted LM head, where column `i` scores token
+        `output_token_ids[i]`. Warpers that only look at the values of the scores run on the compact scores directly.
+        Any other processor indexes the vocabulary by token id, so it runs on full vocabulary scores (tokens outside of
+        `output_token_ids` at `-inf`) that are gathered back afterwards, unless it declares `compact_scores = True`.
+        `MinNewTokensLengthLogitsProcessor` runs on a copy whose EOS ids are replaced by their compact columns.
+        Consecutive processors of the same kind share one round trip.
+        """
+        compact_processors = (TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper, MinPLogitsWarper)
+        groups = []
+        for processor in logits_processor:
+            if isinstance(processor, MinNewTokensLengthLogitsProcessor):
+                # EOS ids outside of `output_token_ids` cannot be produced anyway, they have no column
+                processor = copy.copy(processor)
+                processor.eos_token_id = torch.isin(
+                    output_token_ids, processor.eos_token_id.to(output_token_ids.device)
+                ).nonzero().flatten()
+            is_compact = (
+                isinstance(processor, compact_processors + (MinNewTokensLengthLogitsProcessor,))
+                or getattr(processor, "compact_scores", False)
+            )
+            if groups and groups[-1][0] == is_compact:
+                groups[-1][1].append(processor)
+            else:
+                groups.append((is_compact, [processor]))
+        vocab_size = self.config.vocab_size
+
+        def process(input_ids, scores):
+            for is_compact, processors in groups:
+                if is_compact:
+                    for processor in processors:
+                        scores = processor(input_ids, scores)
+                    continue
+                full_scores = scores.new_full((scores.shape[0], vocab_size), -float("inf"))
+                full_scores[:, output_token_ids] = scores
+                for processor in processors:
+                    full_scores = processor(input_ids, full_scores)
+                scores = full_scores[:, output_token_ids]
+            return scores
+
+        return process
+
+    def _get_static_unconditional_inputs(
+        self,
+        unconditional_attention_mask: torch.LongTensor,
+        unconditional_past_key_values: StaticCache,
+        num_tokens: int = 1,
+    ) -> Dict[str, torch.Tensor]:
+        r"""
+        Inputs of the unconditional (CFG) stream for `num_tokens` new tokens with a `StaticCache`: their cache
+        positions, their position ids and a 4D mask over the whole cache, as `prepare_inputs_for_generation` builds
+        them for the conditional stream. `unconditional_attention_mask` covers the cached tokens and the new tokens.
+        """
+        batch_size, length = unconditional_attention_mask.shape
+        cache_position = torch.arange(length - num_tokens, length, device=unconditional_attention_mask.device)
+        position_ids = unconditional_attention_mask.long().cumsum(-1)[:, -num_tokens:] - 1
+        position_ids.masked_fill_(unconditional_attention_mask[:, -num_tokens:] == 0, 1)
+        base_model = getattr(self, self.base_model_prefix, self)
+        causal_mask = base_model._prepare_4d_causal_attention_mask_with_cache_position(
+            unconditional_attention_mask,
+            sequence_length=num_tokens,
+            target_length=unconditional_past_key_values.get_max_cache_shape(),
+            dtype=self.dtype,
+            device=unconditional_attention_mask.device,
+            cache_position=cache_position,
+            batch_size=batch_size,
+            config=self.config,
+            past_key_values=unconditional_past_key_values,
+        )
+        return {
+            "unconditional_cache_position": cache_position,
+            "unconditional_position_ids": position_ids,
+            "unconditional_attention_mask": causal_mask,
+        }
+
     def _sample(
         self,
         input_ids: torch.LongTensor,
@@ -3234,26 +3325,115 @@ class GenerationMixin:
         unfinished_sequences = torch.ones(batch_size, dtype=torch.long, device=input_ids.device)
         model_kwargs = self._get_initial_cache_position(input_ids, model_kwargs)
 
+        # With a `StaticCache` every decoding step has the same shapes (4D masks over the whole caches, explicit
+        # positions), so the compiled step is traced once and reused by later `generate` calls
         model_forward = self.__call__
-        if isinstance(model_kwargs.get("past_key_values"), StaticCache):
-            if self.device.type == "cuda":
-                logger.warning_once("Using `torch.compile`.")
-                os.environ["TOKENIZERS_PARALLELISM"] = "0"
-                model_forward = self.get_compiled_call(generation_config.compile_config)
+        static_cache = isinstance(model_kwargs.get("past_key_values"), StaticCache)
+        if static_cache:
+            logger.warning_once("Using `torch.compile`.")
+            os.environ["TOKENIZERS_PARALLELISM"] = "0"
+            model_forward = self.get_compiled_call(generation_config.compile_config)
 
         is_prefill = True
         i = 0
-        unconditional_cache_position = 0
-        unconditional_past_key_values = None
+        # The unconditional (CFG) stream cache is owned by the caller when passed in, so that it can be continued
+        # across `generate` calls in the same way as `past_key_values`
+        unconditional_past_key_values = model_kwargs.pop("unconditional_past_key_values", None)
+        unconditional_attention_mask = model_kwargs.pop("unconditional_attention_mask", None)
 
         unconditional_guidance = getattr(self,"_guidance_scale", 0 )
+        sampling_generators = getattr(self, "_sampling_generators", None)
+
+        # With a restricted LM head the logits only cover `output_token_ids`: processors are adapted to the compact
+        # scores and sampled indices are mapped back to token ids
+        # Fused sampling: the trailing sampling warpers are applied by `_fused_sample` together with the sampling step
+        # (prompt lookup verification keeps the full `logits_processor`, it needs the probabilities)
+        step_processor, fused_kwargs = logits_processor, None
+        if do_sample and getattr(self, "_fused_sampling", False) and not (return_dict_in_generate and output_scores):
+            step_processor, fused_kwargs = _split_fused_warpers(logits_processor)
+        top_p_bound = 256
+
+        output_token_ids = getattr(self, "output_token_ids", None)
+        if output_token_ids is not None:
+            output_token_ids = output_token_ids.to(input_ids.device)
+            logits_processor = self._get_restricted_vocab_processor(logits_processor, output_token_ids)
+            step_processor = self._get_restricted_vocab_processor(step_processor, output_token_ids)
+
+        # Prompt lookup decoding: drafts copied from the context are verified in a single forward pass and accepted
+        # with speculative (rejection) sampling, which leaves the sampling distribution unchanged
+        lookup_num_tokens = getattr(self, "_lookup_num_tokens", 0)
+        lookup_ngram_size = getattr(self, "_lookup_ngram_size", 3)
+        if lookup_num_tokens > 0 and (
+            batch_size > 1
+            or output_attentions
+            or output_hidden_states
+            or synced_gpus
+            or not isinstance(model_kwargs.get("past_key_values"), DynamicCache)
+        ):
+            logger.warning_once(
+                "Prompt lookup decoding needs a batch size of 1 and a `DynamicCache`, it has been disabled."
+            )
+            lookup_num_tokens = 0
+        lookup_indices = None
+        if lookup_num_tokens > 0 and output_token_ids is not None:
+            # position of each token id in the compact scores of a restricted LM head, -1 if it cannot be produced
+            lookup_indices = torch.full((self.config.vocab_size,), -1, dtype=torch.long, device=input_ids.device)
+            lookup_indices[output_token_ids] = torch.arange(output_token_ids.shape[0], device=input_ids.device)
+        lookup_generator = sampling_generators[0] if sampling_generators is not None else None
+
+        # Adaptive guidance: the schedule decides on which steps the unconditional stream runs. The tokens of the
+        # skipped steps are fed to it on its next pass (their mask columns wait in `unconditional_pending_mask`).
+        guidance_schedule = getattr(self, "_guidance_schedule", None) if unconditional_guidance > 0 else None
+        if guidance_schedule is not None:
+            guidance_schedule.start()
+            if lookup_num_tokens > 0 and guidance_schedule.mode != "always":
+                logger.warning_once("Prompt lookup decoding runs the unconditional stream on every step, it has been disabled.")
+                lookup_num_tokens = 0
+        unconditional_pending_mask = None
 
         # unconditional_guidance = 0
-        if unconditional_guidance > 0:
-            unconditional_past_key_values = DynamicCache()
-            unconditional_cache_position =  torch.ones_like(input_ids[0, -1:], dtype=torch.int64).cumsum(0) - 1
+        if unconditional_guidance > 0 and unconditional_past_key_values is None:
+            if static_cache:
+                past_key_values = model_kwargs["past_key_values"]
+                unconditional_past_key_values = StaticCache(
+                    self.config,
+                    max_batch_size=batch_size,
+                    max_cache_len=past_key_values.get_max_cache_shape(),
+                    device=input_ids.device,
+                    dtype=past_key_values.key_cache[0].dtype,
+                )
+            else:
+                unconditional_past_key_values = DynamicCache()
+        if unconditional_guidance > 0 and unconditional_attention_mask is None:
+            unconditional_attention_mask = torch.ones(
+                (batch_size, unconditional_past_key_values.get_seq_length()), dtype=torch.long, device=input_ids.device
+            )
 
 
+        # Chunked prefill: the prompt tokens before the last `prefill_chunk_size` ones are fed to the conditional stream
+        # in blocks, which bounds the activation memory of long prompts. The last block is the regular prefill step,
+        # it also feeds the unconditional stream and computes the logits of the last position only.
+        prefill_chunk_size = getattr(self, "_prefill_chunk_size", 0)
+        if prefill_chunk_size > 0:
+            cache_position = model_kwargs["cache_position"]
+            attention_mask = model_kwargs.get("attention_mask")
+            while cache_position.shape[0] > prefill_chunk_size:
+                chunk_end = cache_position[prefill_chunk_size].item()
+                chunk_kwargs = dict(model_kwargs)
+                chunk_kwargs["cache_position"] = cache_position[:prefill_chunk_size]
+                if attention_mask is not None:
+                    chunk_kwargs["attention_mask"] = attention_mask[:, :chunk_end]
+                model_inputs = self.prepare_inputs_for_generation(input_ids[:, :chunk_end], **chunk_kwargs)
+                self(**model_inputs, return_dict=True)
+                cache_position = cache_position[prefill_chunk_size:]
+            model_kwargs["cache_position"] = cache_position
+
+        # Generated tokens are written into a preallocated buffer, `input_ids` is the view of its first `cur_len`
+        # columns (processors, stopping criteria and the streamer only read it)
+        output_ids = input_ids.new_full((batch_size, max(max_length, cur_len)), 0 if pad_token_id is None else pad_token_id)
+        output_ids[:, :cur_len] = input_ids
+        input_ids = output_ids[:, :cur_len]
+
         prompt_length = input_ids.shape[1]
         # expanded_input_ids = torch.empty( (2, prompt_length ), dtype= input_ids.dtype, device =input_ids.device )
         # expanded_input_ids[0] = input_ids
@@ -3265,14 +3445,142 @@ class GenerationMixin:
         while self._has_unfinished_sequences(
             this_peer_finished, synced_gpus, device=input_ids.device, cur_len=cur_len, max_length=max_length
         ):
+            draft_ids = None
+            if lookup_num_tokens > 0 and not is_prefill:
+                draft_ids = _prompt_lookup_draft(
+                    input_ids, lookup_ngram_size, min(lookup_num_tokens, max_length - cur_len - 1)
+                )
+            if draft_ids is not None:
+                # feed the last token followed by the drafts to both streams and score every position at once
+                num_draft = draft_ids.shape[1]
+                attention_mask = model_kwargs.get("attention_mask")
+                candidate_kwargs = dict(model_kwargs)
+                candidate_kwargs["cache_position"] = torch.arange(
+                    cur_len - 1, cur_len + num_draft, device=input_ids.device
+                )
+                if attention_mask is not None:
+                    candidate_kwargs["attention_mask"] = torch.cat(
+                        [attention_mask, attention_mask.new_ones((batch_size, num_draft))], dim=-1
+                    )
+                # the drafts are written after the current tokens, accepted or not they are overwritten below
+                output_ids[:, cur_len : cur_len + num_draft] = draft_ids
+                model_inputs = self.prepare_inputs_for_generation(
+                    output_ids[:, : cur_len + num_draft], **candidate_kwargs
+                )
+                model_inputs["num_logits_to_keep"] = num_draft + 1
+                model_inputs["prompt_length"] = prompt_length
+                model_inputs["unconditional_guidance"] = unconditional_guidance
+                if unconditional_guidance > 0:
+                    unconditional_length = unconditional_past_key_values.get_seq_length()
+                    model_inputs["unconditional_past_key_values"] = unconditional_past_key_values
+                    model_inputs["unconditional_attention_mask"] = torch.cat(
+                        [unconditional_attention_mask, unconditional_attention_mask.new_ones((batch_size, num_draft + 1))],
+                        dim=-1,
+                    )
+                    model_inputs["unconditional_input_ids"] = model_inputs["input_ids"]
+                outputs = self(**model_inputs, return_dict=True)
+
+                num_new_tokens = 0
+                for position in range(num_draft + 1):
+                    next_token_logits = outputs.logits[:, position, :].clone().float()
+                    next_token_logits = next_token_logits.to(input_ids.device)
+                    if unconditional_guidance > 0:
+                        conditional_scores = torch.nn.functional.log_softmax(next_token_logits, dim=-1)
+                        unconditional_scores = torch.nn.functional.log_softmax(
+                            outputs["unconditional_logits"][:, position], dim=-1
+                        )
+                        next_token_scores = (
+                            unconditional_guidance * (conditional_scores - unconditional_scores) + unconditional_scores
+                        )
+                    else:
+                        next_token_scores = next_token_logits
+                    next_token_scores = logits_processor(input_ids, next_token_scores)
+                    if return_dict_in_generate:
+                        if output_scores:
+                            scores += (next_token_scores,)
+                        if output_logits:
+                            raw_logits += (next_token_logits,)
+
+                    accepted = False
+                    if position < num_draft:
+                        draft_index = draft_ids[0, position]
+                        if lookup_indices is not None:
+                            draft_index = lookup_indices[draft_index]
+                        draft_index = draft_index.item()
+                    if do_sample:
+                        probs = nn.functional.softmax(next_token_scores, dim=-1)
+                        if position < num_draft and draft_index >= 0:
+                            # the draft is deterministic: accept it with its probability, otherwise sample from the
+                            # distribution with the draft token removed
+                            draft_prob = probs[0, draft_index]
+                            accepted = torch.rand(1, generator=lookup_generator, device=probs.device) < draft_prob
+                            accepted = accepted.item()
+                            probs[0, draft_index] = 0
+                        if accepted:
+                            next_tokens = torch.tensor([draft_index], device=input_ids.device)
+                        else:
+                            next_tokens = torch.multinomial(probs, num_samples=1, generator=lookup_generator).squeeze(1)
+                    else:
+                        next_tokens = torch.argmax(next_token_scores, dim=-1)
+                        accepted = position < num_draft and next_tokens.item() == draft_index
+                    if output_token_ids is not None:
+                        next_tokens = output_token_ids[next_tokens]
+
+                    output_ids[:, cur_len] = next_tokens
+                    input_ids = output_ids[:, : cur_len + 1]
+                    if streamer is not None:
+                        streamer.put(next_tokens.cpu())
+                    unfinished_sequences = unfinished_sequences & ~stopping_criteria(input_ids, scores)
+                    cur_len += 1
+                    num_new_tokens += 1
+                    if not accepted or unfinished_sequences.max() == 0:
+                        break
+                this_peer_finished = unfinished_sequences.max() == 0
+
+                # drop the cache entries of the rejected drafts: the last token is fed on the next step
+                model_kwargs["past_key_values"].crop(cur_len - 1)
+                if attention_mask is not None:
+                    model_kwargs["attention_mask"] = torch.cat(
+                        [attention_mask, attention_mask.new_ones((batch_size, num_new_tokens))], dim=-1
+                    )
+                model_kwargs["cache_position"] = torch.tensor([cur_len - 1], device=input_ids.device)
+                if unconditional_guidance > 0:
+                    unconditional_past_key_values.crop(unconditional_length + num_new_tokens)
+                    unconditional_attention_mask = torch.cat(
+                        [unconditional_attention_mask, unconditional_attention_mask.new_ones((batch_size, num_new_tokens))],
+                        dim=-1,
+                    )
+                del outputs
+                continue
+
             # prepare model inputs
             model_inputs = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
-            model_inputs["prompt_length"] = prompt_length
-            model_inputs["unconditional_guidance"] = unconditional_guidance
+            if not static_cache:
+                model_inputs["prompt_length"] = prompt_length
+            run_unconditional = unconditional_guidance > 0 and (guidance_schedule is None or guidance_schedule.step())
+            # the model only checks whether guidance is enabled, the scale is applied below (a constant value also
+            # avoids recompiling the compiled step when the scale changes)
+            model_inputs["unconditional_guidance"] = 1 if run_unconditional else 0
             if unconditional_guidance > 0:
-                model_inputs["unconditional_guidance"] = unconditional_guidance
+                # the unconditional stream is fed one token per step; tokens of finished rows are padding
+                new_mask = unfinished_sequences[:, None].to(unconditional_attention_mask.dtype)
+                if unconditional_pending_mask is not None:
+                    new_mask = torch.cat([unconditional_pending_mask, new_mask], dim=-1)
+                unconditional_pending_mask = None if run_unconditional else new_mask
+            if run_unconditional:
+                num_unconditional_tokens = new_mask.shape[1]
                 model_inputs["unconditional_past_key_values"] = unconditional_past_key_values
-                model_inputs["unconditional_cache_position"] = unconditional_cache_position
+                unconditional_attention_mask = torch.cat([unconditional_attention_mask, new_mask], dim=-1)
+                model_inputs["unconditional_attention_mask"] = unconditional_attention_mask
+                if num_unconditional_tokens > 1:
+                    # catch up on the tokens of the skipped steps
+                    model_inputs["unconditional_input_ids"] = input_ids[:, -num_unconditional_tokens:]
+                if static_cache:
+                    model_inputs.update(
+                        self._get_static_unconditional_inputs(
+                            unconditional_attention_mask, unconditional_past_key_values, num_unconditional_tokens
+                        )
+                    )
 
 
                 
@@ -3311,13 +3619,27 @@ class GenerationMixin:
             # pre-process distribution
             #####################
             if unconditional_guidance > 0:
-                scores = torch.nn.functional.log_softmax(next_token_logits, dim=-1)                
-                unconditional_logits = outputs["unconditional_logits"]
-                unconditional_scores = torch.nn.functional.log_softmax(unconditional_logits[:, -1], dim=-1)
-                next_token_scores = unconditional_guidance * (scores - unconditional_scores) + unconditional_scores                
-                next_token_scores = logits_processor(input_ids, next_token_scores)
+                # note: with a restricted LM head both log_softmax are normalized over `output_token_ids` only, which
+                # shifts the guided scores by a per-row constant. Sampling warpers are invariant to that shift, a
+                # repetition penalty is not.
+                conditional_scores = torch.nn.functional.log_softmax(next_token_logits, dim=-1)
+                unconditional_scores = None
+                if run_unconditional:
+                    unconditional_logits = outputs["unconditional_logits"]
+                    unconditional_scores = torch.nn.functional.log_softmax(unconditional_logits[:, -1], dim=-1)
+                if guidance_schedule is not None:
+                    unconditional_scores = guidance_schedule.guide(
+                        conditional_scores, unconditional_scores, unfinished_sequences
+                    )
+                if unconditional_scores is None:
+                    next_token_scores = conditional_scores
+                else:
+                    next_token_scores = (
+                        unconditional_guidance * (conditional_scores - unconditional_scores) + unconditional_scores
+                    )
+                next_token_scores = step_processor(input_ids, next_token_scores)
             else:
-                next_token_scores = logits_processor(input_ids, next_token_logits)
+                next_token_scores = step_processor(input_ids, next_token_logits)
 
             # Store scores, attentions and hidden_states when required
             if return_dict_in_generate:
@@ -3340,19 +3662,35 @@ class GenerationMixin:
                     )
 
             # token selection
-            if do_sample:
+            if fused_kwargs is not None:
+                next_tokens, top_p_bound = _fused_sample(
+                    next_token_scores, generators=sampling_generators, top_p_bound=top_p_bound, **fused_kwargs
+                )
+            elif do_sample:
                 probs = nn.functional.softmax(next_token_scores, dim=-1)
-                # TODO (joao): this OP throws "skipping cudagraphs due to ['incompatible ops']", find solution
-                next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+                if sampling_generators is not None:
+                    # one RNG stream per row, so that every row of the batch is an independent candidate
+                    next_tokens = torch.cat(
+                        [
+                            torch.multinomial(probs[row : row + 1], num_samples=1, generator=generator)
+                            for row, generator in enumerate(sampling_generators)
+                        ]
+                    ).squeeze(1)
+                else:
+                    # TODO (joao): this OP throws "skipping cudagraphs due to ['incompatible ops']", find solution
+                    next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
             else:
                 next_tokens = torch.argmax(next_token_scores, dim=-1)
+            if output_token_ids is not None:
+                next_tokens = output_token_ids[next_tokens]
 
             # finished sentences should have their next token be a padding token
             if has_eos_stopping_criteria:
                 next_tokens = next_tokens * unfinished_sequences + pad_token_id * (1 - unfinished_sequences)
 
             # update generated ids, model inputs, and length for next step
-            input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
+            output_ids[:, cur_len] = next_tokens
+            input_ids = output_ids[:, : cur_len + 1]
             if streamer is not None:
                 streamer.put(next_tokens.cpu())
 
@@ -3366,6 +3704,8 @@ class GenerationMixin:
 
         if streamer is not None:
             streamer.end()
+        # the returned sequences do not keep the unused columns of the buffer alive
+        input_ids = input_ids.clone()
 
         if return_dict_in_generate:
             if self.config.is_encoder_decoder:
@@ -3381,7 +3721,7 @@ class GenerationMixin:
                     past_key_values=model_kwargs.get("past_key_values"),
                 )
             else:
-                return GenerateDecoderOnlyOutput(
+                output = GenerateDecoderOnlyOutput(
                     sequences=input_ids,
                     scores=scores,
                     logits=raw_logits,
@@ -3389,6 +3729,10 @@ class GenerationMixin:
                     hidden_states=decoder_hidden_states,
                     past_key_values=model_kwargs.get("past_key_values"),
                 )
+                if unconditional_guidance > 0:
+                    output["unconditional_past_key_values"] = unconditional_past_key_values
+                    output["unconditional_attention_mask"] = unconditional_attention_mask
+                return output
         else:
             return input_ids
 
@@ -4496,6 +4840,119 @@ class GenerationMixin:
             return input_ids
 
 
+def _prompt_lookup_draft(input_ids: torch.LongTensor, max_ngram_size: int, num_tokens: int) -> Optional[torch.LongTensor]:
+    """
+    Drafts up to `num_tokens` tokens for prompt lookup decoding: the tokens that followed the most recent earlier
+    occurrence of the trailing n-gram of `input_ids` (batch size 1), trying the longest n-gram first. Returns `None`
+    when nothing matches.
+    """
+    if num_tokens <= 0:
+        return None
+    sequence = input_ids[0]
+    for ngram_size in range(min(max_ngram_size, sequence.shape[0] - 1), 0, -1):
+        # the last window is the trailing n-gram itself
+        windows = sequence.unfold(0, ngram_size, 1)[:-1]
+        matches = (windows == sequence[-ngram_size:]).all(dim=1).nonzero()
+        if matches.shape[0] > 0:
+            start = matches[-1, 0].item() + ngram_size
+            return sequence[start : start + num_tokens][None]
+    return None
+
+
+def _split_fused_warpers(logits_processor: LogitsProcessorList) -> Tuple[LogitsProcessorList, Optional[dict]]:
+    """
+    Splits the trailing temperature, top-k and top-p warpers (in the order `generate` builds them) off
+    `logits_processor`, so that `_fused_sample` can apply them together with the sampling step. Returns the remaining
+    processors and the `_fused_sample` arguments, `None` if there are no warpers to fuse.
+    """
+    fusable = (TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper)
+    num_warpers = 0
+    while num_warpers < len(logits_processor) and isinstance(logits_processor[-num_warpers - 1], fusable):
+        num_warpers += 1
+    warpers = list(logits_processor)[len(logits_processor) - num_warpers :]
+    # every warper at most once, in the `generate` order, with the default filtering
+    positions = [[isinstance(warper, warper_class) for warper_class in fusable].index(True) for warper in warpers]
+    while warpers and (
+        positions != sorted(set(positions))
+        or any(getattr(warper, "min_tokens_to_keep", 1) != 1 for warper in warpers)
+        or any(getattr(warper, "filter_value", -float("inf")) != -float("inf") for warper in warpers)
+    ):
+        warpers, positions = warpers[1:], positions[1:]
+    if not warpers:
+        return logits_processor, None
+    fused_kwargs = {"temperature": 1.0, "top_k": None, "top_p": 1.0}
+    for warper in warpers:
+        if isinstance(warper, TemperatureLogitsWarper):
+            fused_kwargs["temperature"] = warper.temperature
+        elif isinstance(warper, TopKLogitsWarper):
+            fused_kwargs["top_k"] = warper.top_k
+        else:
+            fused_kwargs["top_p"] = warper.top_p
+    return LogitsProcessorList(list(logits_processor)[: len(logits_processor) - len(warpers)]), fused_kwargs
+
+
+def _fused_sample(
+    scores: torch.FloatTensor,
+    temperature: float = 1.0,
+    top_k: Optional[int] = None,
+    top_p: float = 1.0,
+    generators: Optional[List[torch.Generator]] = None,
+    top_p_bound: int = 256,
+) -> Tuple[torch.LongTensor, int]:
+    """
+    Samples one token per row from `scores` as `TemperatureLogitsWarper`, `TopKLogitsWarper` and `TopPLogitsWarper`
+    followed by softmax and `torch.multinomial` do, without sorting or normalizing the whole vocabulary: the nucleus is
+    searched among the `top_k` (or, without top-k, the `top_p_bound`) highest scores and the token is drawn with the
+    Gumbel-max trick, `argmax(p / E)` with `E ~ Exp(1)`. If the `top_p_bound` candidates hold less than `top_p` of the
+    probability mass of a row, the bound is raised until they do. Returns the sampled indices and the bound used.
+    """
+    if temperature != 1.0:
+        scores = scores / temperature
+    vocab_size = scores.shape[-1]
+    log_normalizer = None
+    if top_k is not None and top_k < vocab_size:
+        num_candidates = top_k
+    elif top_p < 1.0:
+        num_candidates = min(top_p_bound, vocab_size)
+        log_normalizer = torch.logsumexp(scores, dim=-1, keepdim=True)
+    else:
+        num_candidates = vocab_size
+
+    while True:
+        if num_candidates < vocab_size:
+            candidate_scores, candidate_indices = torch.topk(scores, num_candidates, dim=-1)
+        elif top_p < 1.0:
+            candidate_scores, candidate_indices = torch.sort(scores, dim=-1, descending=True)
+        else:
+            candidate_scores, candidate_indices = scores, None
+        # with top-k the distribution is renormalized over the candidates
+        normalizer = log_normalizer
+        if normalizer is None:
+            normalizer = torch.logsumexp(candidate_scores, dim=-1, keepdim=True)
+        probs = (candidate_scores - normalizer).exp()
+        if top_p >= 1.0:
+            break
+        cumulative_probs = probs.cumsum(dim=-1)
+        # same tokens as `TopPLogitsWarper`: those whose more likely tokens hold less than `top_p` of the mass
+        keep = cumulative_probs - probs < top_p
+        if log_normalizer is None or num_candidates == vocab_size or (cumulative_probs[:, -1] >= top_p).all():
+            probs = probs.masked_fill(~keep, 0)
+            break
+        num_candidates = min(num_candidates * 4, vocab_size)
+        top_p_bound = num_candidates
+
+    noise = torch.empty_like(probs)
+    if generators is not None:
+        for row, generator in enumerate(generators):
+            noise[row].exponential_(generator=generator)
+    else:
+        noise.exponential_()
+    choices = (probs / noise.clamp_(min=torch.finfo(noise.dtype).tiny)).argmax(dim=-1)
+    if candidate_indices is not None:
+        choices = candidate_indices.gather(-1, choices[:, None]).squeeze(1)
+    return choices, top_p_bound
+
+
 def _speculative_sampling(
     candidate_input_ids,
     candidate_logits,
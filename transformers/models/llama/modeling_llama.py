@@ -258,6 +258,11 @@ class LlamaAttention(nn.Module):
         attention_mask: Optional[torch.Tensor],
         past_key_value: Optional[Cache] = None,
         cache_position: Optional[torch.LongTensor] = None,
+        unconditional_length: int = 0,
+        unconditional_position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        unconditional_attention_mask: Optional[torch.Tensor] = None,
+        unconditional_past_key_value: Optional[Cache] = None,
+        unconditional_cache_position: Optional[torch.LongTensor] = None,
         **kwargs: Unpack[FlashAttentionKwargs],
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
         input_shape = hidden_states.shape[:-1]
@@ -267,14 +272,6 @@ class LlamaAttention(nn.Module):
         key_states = self.k_proj(hidden_states).view(hidden_shape).transpose(1, 2)
         value_states = self.v_proj(hidden_states).view(hidden_shape).transpose(1, 2)
 
-        cos, sin = position_embeddings
-        query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin)
-
-        if past_key_value is not None:
-            # sin and cos are specific to RoPE models; cache_position needed for the static cache
-            cache_kwargs = {"sin": sin, "cos": cos, "cache_position": cache_position}
-            key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
-
         attention_interface: Callable = eager_attention_forward
         if self.config._attn_implementation != "eager":
             if self.config._attn_implementation == "sdpa" and kwargs.get("output_attentions", False):
@@ -285,17 +282,48 @@ class LlamaAttention(nn.Module):
             else:
                 attention_interface = ALL_ATTENTION_FUNCTIONS[self.config._attn_implementation]
 
-        attn_output, attn_weights = attention_interface(
-            self,
-            query_states,
-            key_states,
-            value_states,
-            attention_mask,
-            dropout=0.0 if not self.training else self.attention_dropout,
-            scaling=self.scaling,
-            **kwargs,
-        )
+        # With classifier-free guidance the last `unconditional_length` tokens belong to the unconditional stream.
+        # The projections above are shared by both streams; rotary positions, cache and mask are per stream.
+        split = input_shape[1] - unconditional_length
+        streams = [(slice(0, split), position_embeddings, attention_mask, past_key_value, cache_position)]
+        if unconditional_length > 0:
+            streams.append(
+                (
+                    slice(split, None),
+                    unconditional_position_embeddings,
+                    unconditional_attention_mask,
+                    unconditional_past_key_value,
+                    unconditional_cache_position,
+                )
+            )
+
+        attn_outputs = []
+        for stream_idx, (tokens, (cos, sin), stream_mask, stream_cache, stream_cache_position) in enumerate(streams):
+            stream_query, stream_key = apply_rotary_pos_emb(
+                query_states[:, :, tokens], key_states[:, :, tokens], cos, sin
+            )
+            stream_value = value_states[:, :, tokens]
+
+            if stream_cache is not None:
+                # sin and cos are specific to RoPE models; cache_position needed for the static cache
+                cache_kwargs = {"sin": sin, "cos": cos, "cache_position": stream_cache_position}
+                stream_key, stream_value = stream_cache.update(stream_key, stream_value, self.layer_idx, cache_kwargs)
+
+            stream_output, stream_weights = attention_interface(
+                self,
+                stream_query,
+                stream_key,
+                stream_value,
+                stream_mask,
+                dropout=0.0 if not self.training else self.attention_dropout,
+                scaling=self.scaling,
+                **kwargs,
+            )
+            attn_outputs.append(stream_output)
+            if stream_idx == 0:
+                attn_weights = stream_weights
 
+        attn_output = torch.cat(attn_outputs, dim=1) if len(attn_outputs) > 1 else attn_outputs[0]
         attn_output = attn_output.reshape(*input_shape, -1).contiguous()
         attn_output = self.o_proj(attn_output)
         return attn_output, attn_weights
@@ -322,8 +350,20 @@ class LlamaDecoderLayer(nn.Module):
         use_cache: Optional[bool] = False,
         cache_position: Optional[torch.LongTensor] = None,
         position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,  # necessary, but kept here for BC
+        unconditional_hidden_states: Optional[torch.Tensor] = None,
+        unconditional_attention_mask: Optional[torch.Tensor] = None,
+        unconditional_past_key_value: Optional[Cache] = None,
+        unconditional_cache_position: Optional[torch.LongTensor] = None,
+        unconditional_position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
         **kwargs: Unpack[FlashAttentionKwargs],
     ) -> Tuple[torch.FloatTensor, Optional[Tuple[torch.FloatTensor, torch.FloatTensor]]]:
+        # The unconditional (CFG) stream is appended to the sequence so that both streams share one pass through
+        # the layer weights; only the attention itself is computed per stream.
+        unconditional_length = 0
+        if unconditional_hidden_states is not None:
+            unconditional_length = unconditional_hidden_states.shape[1]
+            hidden_states = torch.cat([hidden_states, unconditional_hidden_states], dim=1)
+
         residual = hidden_states
 
         hidden_states = self.input_layernorm(hidden_states)
@@ -338,6 +378,11 @@ class LlamaDecoderLayer(nn.Module):
             use_cache=use_cache,
             cache_position=cache_position,
             position_embeddings=position_embeddings,
+            unconditional_length=unconditional_length,
+            unconditional_position_embeddings=unconditional_position_embeddings,
+            unconditional_attention_mask=unconditional_attention_mask,
+            unconditional_past_key_value=unconditional_past_key_value,
+            unconditional_cache_position=unconditional_cache_position,
             **kwargs,
         )
         hidden_states = residual + hidden_states
@@ -348,10 +393,16 @@ class LlamaDecoderLayer(nn.Module):
         hidden_states = self.mlp(hidden_states)
         hidden_states = residual + hidden_states
 
+        if unconditional_length > 0:
+            split = hidden_states.shape[1] - unconditional_length
+            hidden_states, unconditional_hidden_states = hidden_states[:, :split], hidden_states[:, split:]
+
         outputs = (hidden_states,)
         if output_attentions:
             pass
             outputs += (self_attn_weights,)
+        if unconditional_length > 0:
+            outputs += (unconditional_hidden_states,)
 
         return outputs
 
@@ -527,6 +578,9 @@ class LlamaModel(LlamaPreTrainedModel):
         unconditional_guidance = 0,
         unconditional_past_key_values: Optional[Cache] = None,
         unconditional_cache_position: Optional[torch.LongTensor] = None,
+        unconditional_attention_mask: Optional[torch.Tensor] = None,
+        unconditional_input_ids: Optional[torch.LongTensor] = None,
+        unconditional_position_ids: Optional[torch.LongTensor] = None,
         prompt_length = 0,
         **flash_attn_kwargs: Unpack[FlashAttentionKwargs],
     ) -> Union[Tuple, BaseModelOutputWithPast]:
@@ -582,11 +636,36 @@ class LlamaModel(LlamaPreTrainedModel):
 
         # create position embeddings to be shared across the decoder layers
         position_embeddings = self.rotary_emb(hidden_states, position_ids)
+        unconditional_hidden_states = None
+        unconditional_causal_mask = None
+        unconditional_position_embeddings = None
         if unconditional_guidance > 0 :
-            unconditional_hidden_states = hidden_states[:, -1:, :]
-            past_seen_tokens = unconditional_past_key_values.get_seq_length() if unconditional_past_key_values is not None else 0
-            unconditional_position_ids = torch.full( (inputs_embeds.shape[0],1) , past_seen_tokens, dtype= torch.int64, device=inputs_embeds.device )
+            # the unconditional stream is fed `unconditional_input_ids` when given, the last input token otherwise
+            if unconditional_input_ids is not None:
+                unconditional_hidden_states = self.embed_tokens(unconditional_input_ids)
+            else:
+                unconditional_hidden_states = hidden_states[:, -1:, :]
+            if unconditional_cache_position is None:
+                past_seen_tokens = unconditional_past_key_values.get_seq_length() if unconditional_past_key_values is not None else 0
+                unconditional_cache_position = torch.arange(
+                    past_seen_tokens, past_seen_tokens + unconditional_hidden_states.shape[1], device=inputs_embeds.device
+                )
+            # positions have to be given with a 4D mask (static cache), they cannot be derived from it
+            if unconditional_position_ids is None and unconditional_attention_mask is not None:
+                # rows of a batch may have finished at different steps, their padding is masked out and skipped
+                unconditional_position_ids = unconditional_attention_mask.long().cumsum(-1) - 1
+                unconditional_position_ids.masked_fill_(unconditional_attention_mask == 0, 1)
+                unconditional_position_ids = unconditional_position_ids[:, -unconditional_hidden_states.shape[1]:]
+            elif unconditional_position_ids is None:
+                unconditional_position_ids = unconditional_cache_position.unsqueeze(0).expand(inputs_embeds.shape[0], -1)
             unconditional_position_embeddings = self.rotary_emb(unconditional_hidden_states, unconditional_position_ids)
+            unconditional_causal_mask = self._update_causal_mask(
+                unconditional_attention_mask,
+                unconditional_hidden_states,
+                unconditional_cache_position,
+                unconditional_past_key_values,
+                False,
+            )
 
 
         # decoder layers
@@ -619,26 +698,17 @@ class LlamaModel(LlamaPreTrainedModel):
                     use_cache=use_cache,
                     cache_position=cache_position,
                     position_embeddings=position_embeddings,
+                    unconditional_hidden_states=unconditional_hidden_states,
+                    unconditional_attention_mask=unconditional_causal_mask,
+                    unconditional_past_key_value=unconditional_past_key_values,
+                    unconditional_cache_position=unconditional_cache_position,
+                    unconditional_position_embeddings=unconditional_position_embeddings,
                     **flash_attn_kwargs,
                 )
 
-                if unconditional_guidance > 0 :
-                    unconditional_layer_outputs = decoder_layer(
-                        unconditional_hidden_states,
-                        attention_mask=None,
-                        position_ids=unconditional_position_ids,
-                        past_key_value=unconditional_past_key_values,
-                        output_attentions=None,
-                        use_cache=use_cache,
-                        cache_position=unconditional_cache_position,
-                        position_embeddings=unconditional_position_embeddings,
-                        **flash_attn_kwargs,
-                    )
-
-
             hidden_states = layer_outputs[0]
             if unconditional_guidance > 0 :
-                unconditional_hidden_states = unconditional_layer_outputs[0]
+                unconditional_hidden_states = layer_outputs[-1]
 
             if output_attentions:
                 all_self_attns += (layer_outputs[1],)
@@ -799,10 +869,43 @@ class LlamaForCausalLM(LlamaPreTrainedModel, GenerationMixin):
         self.model = LlamaModel(config)
         self.vocab_size = config.vocab_size
         self.lm_head = nn.Linear(config.hidden_size, config.vocab_size, bias=False)
+        # optional restriction of the LM head to a subset of the vocabulary, see `set_output_token_ids`
+        self.output_token_ids = None
+        self._output_weight = None
+        self._output_weight_key = None
 
         # Initialize weights and apply final processing
         self.post_init()
 
+    def set_output_token_ids(self, output_token_ids=None):
+        r"""
+        Restricts the LM head to the token ids in `output_token_ids`: `logits[..., i]` is then the logit of token
+        `output_token_ids[i]` and tokens outside of the set cannot be produced. `generate` maps the sampled indices
+        back to token ids. Pass `None` to restore the full vocabulary.
+        """
+        if output_token_ids is not None:
+            output_token_ids = torch.as_tensor(output_token_ids, dtype=torch.long, device=self.lm_head.weight.device)
+        self.output_token_ids = output_token_ids
+        self._output_weight = None
+        self._output_weight_key = None
+
+    def _output_logits(self, hidden_states):
+        if self.output_token_ids is None:
+            return self.lm_head(hidden_states)
+        if torch.compiler.is_compiling() and self._output_weight is not None:
+            # compiled decode steps follow an eager prefill, which built the sliced weight
+            return nn.functional.linear(hidden_states, self._output_weight)
+        weight = self.lm_head.weight
+        # the sliced weight is rebuilt whenever the LM head weight is replaced or moved (e.g. by offloading)
+        key = (weight.data_ptr(), weight.device, hidden_states.device)
+        if self._output_weight_key != key:
+            with torch.no_grad():
+                output_token_ids = self.output_token_ids.to(weight.device)
+                self._output_weight = weight[output_token_ids].to(hidden_states.device)
+            self.output_token_ids = self.output_token_ids.to(hidden_states.device)
+            self._output_weight_key = key
+        return nn.functional.linear(hidden_states, self._output_weight)
+
     def get_input_embeddings(self):
         return self.model.embed_tokens
 
@@ -840,6 +943,9 @@ class LlamaForCausalLM(LlamaPreTrainedModel, GenerationMixin):
         unconditional_guidance = 0,
         unconditional_past_key_values: Optional[Cache] = None,
         unconditional_cache_position: Optional[torch.LongTensor] = None,
+        unconditional_attention_mask: Optional[torch.Tensor] = None,
+        unconditional_input_ids: Optional[torch.LongTensor] = None,
+        unconditional_position_ids: Optional[torch.LongTensor] = None,
         prompt_length = 0,
         **kwargs: Unpack[KwargsForCausalLM],
     ) -> Union[Tuple, CausalLMOutputWithPast]:
@@ -894,16 +1000,21 @@ class LlamaForCausalLM(LlamaPreTrainedModel, GenerationMixin):
             unconditional_guidance=unconditional_guidance,
             unconditional_past_key_values = unconditional_past_key_values,
             unconditional_cache_position = unconditional_cache_position,
+            unconditional_attention_mask = unconditional_attention_mask,
+            unconditional_input_ids = unconditional_input_ids,
+            unconditional_position_ids = unconditional_position_ids,
             prompt_length = prompt_length,
             **kwargs,
         )
 
         hidden_states = outputs[0]
         # Only compute necessary logits, and do not upcast them to float if we are not computing the loss
-        logits = self.lm_head(hidden_states[:, -num_logits_to_keep:, :])
+        logits = self._output_logits(hidden_states[:, -num_logits_to_keep:, :])
 
         loss = None
         if labels is not None:
+            if self.output_token_ids is not None:
+                raise ValueError("Computing a loss is not supported with a restricted LM head, see `set_output_token_ids`.")
             loss = self.loss_function(logits=logits, labels=labels, vocab_size=self.config.vocab_size, **kwargs)
 
         if not return_dict:
@@ -921,7 +1032,7 @@ class LlamaForCausalLM(LlamaPreTrainedModel, GenerationMixin):
         if unconditional_guidance > 0:
             unconditional_hidden_states = outputs["last_unconditional_hidden_state"]
             unconditional_past_key_values = outputs["unconditional_past_key_values"]
-            unconditional_logits = self.lm_head(unconditional_hidden_states[:, -num_logits_to_keep:, :])
+            unconditional_logits = self._output_logits(unconditional_hidden_states[:, -num_logits_to_keep:, :])
             ret["unconditional_logits"] = unconditional_logits
             ret["unconditional_past_key_values"] = unconditional_past_key_values
         return ret